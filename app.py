@@ -1,43 +1,315 @@
+import click
 import requests
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
+from flask import (Flask, render_template, request, redirect, url_for, flash, session, jsonify, g, make_response,
+                   Response, stream_with_context)
 from flask_pymongo import PyMongo
+from pymongo import ASCENDING, DESCENDING, CursorType, IndexModel, ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from apscheduler.schedulers.background import BackgroundScheduler
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timedelta, timezone
 from functools import wraps
+from bson import json_util
+from bson.errors import InvalidId
 from bson.objectid import ObjectId
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+import base64
+import hashlib
+import heapq
+import json
 import os
+import queue
+import re
+import socket
+import threading
+import time
+import unicodedata
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from werkzeug.utils import secure_filename
 
 app = Flask(__name__)
-app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY")
-app.config["MONGO_URI"] = os.environ.get("MONGO_URI")
+mongo = PyMongo()
+
+
+def create_app(config=None):
+    """应用工厂：加载配置并初始化扩展。
+
+    启动阶段不访问数据库（不 ping、不建索引），索引由 `flask --app app migrate` 统一维护。
+    重复调用直接返回已初始化的应用，多个入口（app.py、CLI）可以放心调用。
+    """
+    if mongo.db is not None:
+        return app
+
+    app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY")
+    app.config["MONGO_URI"] = os.environ.get("MONGO_URI")
+    # 紧急日志保留时长（秒），由 emergency_logs 上的 TTL 索引负责过期删除
+    app.config["EMERGENCY_LOG_TTL_SECONDS"] = int(os.environ.get("EMERGENCY_LOG_TTL_SECONDS", 3600))
+    # 是否把紧急日志同时写入不过期的归档集合，供管理员查询历史
+    app.config["EMERGENCY_LOG_ARCHIVE"] = os.environ.get("EMERGENCY_LOG_ARCHIVE", "").lower() in ("1", "true", "yes")
+    # 实时推送的跨 worker 后端：mongo（capped 集合，多 worker 可用）或 local（仅单进程）
+    app.config["EVENT_BROKER_BACKEND"] = os.environ.get("EVENT_BROKER_BACKEND", "mongo")
+    app.config["EVENT_STREAM_CAPPED_BYTES"] = int(os.environ.get("EVENT_STREAM_CAPPED_BYTES", 16 * 1024 * 1024))
+    # 单个 SSE 连接的最长时间，到期后浏览器会自动重连，便于 worker 回收
+    app.config["SSE_MAX_STREAM_SECONDS"] = int(os.environ.get("SSE_MAX_STREAM_SECONDS", 300))
+    # 每个 worker 的请求线程数（gunicorn.conf.py 按 worker 类型传入）以及其中留给普通请求的线程数。
+    # SSE 推送、AI 流式回复和同步等待 AI 回复都会长时间占用一个线程，同时最多 REQUEST_THREADS - RESERVED_REQUEST_THREADS 个
+    app.config["REQUEST_THREADS"] = int(os.environ.get("REQUEST_THREADS", 8))
+    app.config["RESERVED_REQUEST_THREADS"] = int(os.environ.get("RESERVED_REQUEST_THREADS", 4))
+    # 是否在本进程中启动后台定时任务（多个 worker 之间通过租约保证同一时刻只有一个执行）
+    app.config["BACKGROUND_JOBS_ENABLED"] = os.environ.get("BACKGROUND_JOBS_ENABLED", "1").lower() in ("1", "true", "yes")
+    # 服药/提醒到期时调用的通知方式，逗号分隔：log（默认）、mail（Flask-Mail）、sms（Twilio）
+    app.config["DUE_NOTIFICATION_HOOKS"] = os.environ.get("DUE_NOTIFICATION_HOOKS", "log")
+    # 通义千问（DashScope OpenAI 兼容接口），启动时读取一次
+    app.config["QWEN_API_KEY"] = os.environ.get("QWEN_API_KEY")
+    app.config["QWEN_API_BASE"] = os.environ.get("QWEN_API_BASE", "https://dashscope.aliyuncs.com/compatible-mode/v1")
+    app.config["QWEN_MODEL"] = os.environ.get("QWEN_MODEL", "qwen3-next-80b-a3b-instruct")
+    app.config["QWEN_CONNECT_TIMEOUT"] = float(os.environ.get("QWEN_CONNECT_TIMEOUT", 5))
+    app.config["QWEN_READ_TIMEOUT"] = float(os.environ.get("QWEN_READ_TIMEOUT", 30))
+    app.config["QWEN_MAX_RETRIES"] = int(os.environ.get("QWEN_MAX_RETRIES", 2))
+    if config:
+        app.config.update(config)
+
+    if not app.config["MONGO_URI"]:
+        raise ValueError("MONGO_URI 环境变量没有配置或为空!")
+
+    # connect=False：首次查询时才建立连接。gunicorn preload 时应用在 master 进程中创建，
+    # 延迟连接可以避免把连接池带进 fork 出来的 worker
+    mongo.init_app(app, connect=False)
+
+    if app.config["EVENT_BROKER_BACKEND"] == "local":
+        event_broker.backend = LocalBrokerBackend(event_broker)
+    else:
+        event_broker.backend = CappedCollectionBrokerBackend(event_broker, EVENT_STREAM_COLLECTION)
+
+    stream_slots.configure(app.config)
+    due_dispatcher.hooks = build_notification_hooks(app.config["DUE_NOTIFICATION_HOOKS"])
+    qwen_client.configure(app.config)
+    return app
+
+
+# 索引清单：覆盖本模块中所有的查询形态。修改清单时请递增版本号，
+# 然后运行 `flask --app app migrate` 应用到数据库。
+INDEX_MANIFEST_VERSION = 11
+INDEX_MANIFEST = {
+    'users': [
+        IndexModel([('email', ASCENDING)], unique=True),
+        IndexModel([('elder_id', ASCENDING)]),
+        # 管理员面板的默认排序和按角色筛选
+        IndexModel([('created_at', DESCENDING)]),
+        IndexModel([('role', ASCENDING), ('created_at', DESCENDING)]),
+    ],
+    'events': [
+        # 社交活动页按 (datetime, _id) 做 keyset 分页
+        IndexModel([('datetime', ASCENDING), ('_id', ASCENDING)]),
+        IndexModel([('organizer_id', ASCENDING)]),
+        IndexModel([('participants', ASCENDING)]),
+    ],
+    'medicines': [
+        IndexModel([('user_id', ASCENDING), ('name', ASCENDING)]),
+        # 到期分发器增量加载新药品
+        IndexModel([('created_at', ASCENDING)]),
+    ],
+    # 只保存服用/跳过记录，计划本身由药品上的规则展开
+    'medicine_schedule': [
+        IndexModel([('user_id', ASCENDING), ('date', ASCENDING)]),
+        # 按 (medicine_id, date) upsert 单次服药记录，每次服药最多一条；migrate 建索引前先清理重复记录
+        IndexModel([('medicine_id', ASCENDING), ('date', ASCENDING)], unique=True),
+        IndexModel([('date', ASCENDING)]),
+        # 子女仪表盘增量轮询
+        IndexModel([('user_id', ASCENDING), ('updated_at', ASCENDING)]),
+    ],
+    'reminders': [
+        # 提醒页和仪表盘按 due_at 做范围查询和排序
+        IndexModel([('user_id', ASCENDING), ('completed', ASCENDING), ('due_at', ASCENDING)]),
+        # 到期分发器按时间窗口加载所有用户的提醒
+        IndexModel([('completed', ASCENDING), ('due_at', ASCENDING)]),
+        # 已完成提醒按 (completed_at, _id) 倒序做 keyset 分页；归档任务按 completed_at 扫描
+        IndexModel([('user_id', ASCENDING), ('completed', ASCENDING),
+                    ('completed_at', DESCENDING), ('_id', DESCENDING)]),
+        IndexModel([('completed', ASCENDING), ('completed_at', ASCENDING)]),
+        IndexModel([('date', ASCENDING)]),
+        IndexModel([('user_id', ASCENDING), ('updated_at', ASCENDING)]),
+        IndexModel([('updated_at', ASCENDING)]),
+    ],
+    'reminders_archive': [
+        IndexModel([('user_id', ASCENDING), ('completed_at', DESCENDING)]),
+    ],
+    'regular_expenses': [
+        IndexModel([('user_id', ASCENDING), ('date', ASCENDING)]),
+        IndexModel([('date', ASCENDING)]),
+    ],
+    'fixed_expenses': [
+        IndexModel([('user_id', ASCENDING), ('is_paid', ASCENDING), ('date', ASCENDING)]),
+        IndexModel([('date', ASCENDING)]),
+    ],
+    'finance_rollups': [
+        IndexModel([('user_id', ASCENDING), ('month', ASCENDING)], unique=True),
+    ],
+    'feedback': [
+        IndexModel([('created_at', DESCENDING)]),
+        IndexModel([('status', ASCENDING), ('created_at', DESCENDING)]),
+    ],
+    'tutorial_requests': [
+        IndexModel([('created_at', DESCENDING)]),
+        IndexModel([('status', ASCENDING), ('created_at', DESCENDING)]),
+        IndexModel([('user_id', ASCENDING), ('created_at', DESCENDING)]),
+    ],
+    'emergency_logs': [
+        IndexModel([('user_id', ASCENDING), ('created_at', DESCENDING)]),
+    ],
+    'emergency_logs_archive': [
+        IndexModel([('created_at', DESCENDING)]),
+        IndexModel([('user_id', ASCENDING), ('created_at', DESCENDING)]),
+    ],
+}
+
+
+def drop_changed_indexes(collection, indexes):
+    """同一组键的索引改了 unique 选项时，create_indexes 会报冲突，先删除旧索引"""
+    wanted = {tuple(index.document['key'].items()): bool(index.document.get('unique')) for index in indexes}
+    for existing in collection.list_indexes():
+        key = tuple(existing['key'].items())
+        if key in wanted and bool(existing.get('unique')) != wanted[key]:
+            collection.drop_index(existing['name'])
+            print(f"{collection.name}: 删除选项已变化的索引 {existing['name']}")
+
+
+def apply_index_manifest(force=False):
+    """按索引清单创建索引，并在 schema_migrations 中记录已应用的版本"""
+    applied = mongo.db.schema_migrations.find_one({'_id': 'indexes'})
+    if not force and applied and applied.get('version', 0) >= INDEX_MANIFEST_VERSION:
+        print(f"索引已是最新版本 (v{applied['version']})，跳过")
+        return False
+
+    for collection_name, indexes in INDEX_MANIFEST.items():
+        drop_changed_indexes(mongo.db[collection_name], indexes)
+        names = mongo.db[collection_name].create_indexes(indexes)
+        print(f"{collection_name}: {', '.join(names)}")
+
+    mongo.db.schema_migrations.update_one(
+        {'_id': 'indexes'},
+        {'$set': {'version': INDEX_MANIFEST_VERSION, 'applied_at': datetime.utcnow()}},
+        upsert=True
+    )
+    print(f"索引清单 v{INDEX_MANIFEST_VERSION} 应用完成")
+    return True
+
+
+def ensure_ttl_index(collection_name, ttl):
+    """创建或调整 collection.created_at 上的 TTL 索引，使其与配置的保留时长一致"""
+    for index in mongo.db[collection_name].list_indexes():
+        if dict(index['key']) == {'created_at': 1}:
+            if index.get('expireAfterSeconds') != ttl:
+                mongo.db.command('collMod', collection_name,
+                                 index={'keyPattern': {'created_at': 1}, 'expireAfterSeconds': ttl})
+                print(f"{collection_name} TTL 调整为 {ttl} 秒")
+            return
+    mongo.db[collection_name].create_index([('created_at', ASCENDING)], expireAfterSeconds=ttl)
+    print(f"{collection_name} TTL 索引已创建 ({ttl} 秒)")
+
 
-if not app.config["MONGO_URI"]:
-    raise ValueError("MONGO_URI 环境变量没有配置或为空!")
+def ensure_emergency_log_ttl():
+    ensure_ttl_index('emergency_logs', app.config["EMERGENCY_LOG_TTL_SECONDS"])
 
-mongo = PyMongo(app)
 
-# 验证MongoDB连接和集合
-try:
-    # 测试数据库连接
+@app.cli.command('migrate')
+@click.option('--force', is_flag=True, help='即使版本未变化也重新应用索引清单')
+def migrate_command(force):
+    """创建/更新所有集合的索引（部署时运行一次，而不是每个 worker 启动时）"""
+    create_app()
     mongo.db.command('ping')
     print("成功连接到MongoDB!")
+    dedupe_medicine_schedule_records()
+    apply_index_manifest(force=force)
+    backfill_reminder_due_at()
+    # TTL 取决于配置而不是清单版本，每次迁移都校验一次
+    ensure_emergency_log_ttl()
+    ensure_event_stream_collection()
+    ensure_ttl_index('assistant_cache', ASSISTANT_CACHE_TTL_SECONDS)
+    ensure_ttl_index('assistant_jobs', ASSISTANT_JOB_TTL_SECONDS)
+    ensure_ttl_index('due_notifications', DUE_NOTIFICATION_RECORD_TTL_SECONDS)
+
+
+@app.cli.command('rebuild-finance-rollups')
+@click.option('--user-id', help='只重建指定用户的汇总')
+def rebuild_finance_rollups_command(user_id):
+    """根据原始支出记录重建 finance_rollups 和 fixed_expense_totals，用于修复汇总偏差"""
+    create_app()
+    count = rebuild_finance_rollups(ObjectId(user_id) if user_id else None)
+    print(f"重建了 {count} 条财务汇总")
+
+
+@app.cli.command('run-job')
+@click.argument('name')
+def run_job_command(name):
+    """立即执行一个后台任务（不检查租约），例如 medicine-schedule-maintenance"""
+    create_app()
+    if name not in BACKGROUND_JOBS:
+        raise click.BadParameter(f"可选任务: {', '.join(BACKGROUND_JOBS)}", param_hint='NAME')
+    BACKGROUND_JOBS[name]['func']()
+
+
+# 后台定时任务注册表：name -> 任务函数、APScheduler 触发参数和租约时长。
+# 每个 worker 都会启动调度器，但任务执行前要先在 scheduler_leases 中抢到租约，
+# 所以同一个任务在所有 worker 中只会执行一次。
+BACKGROUND_JOBS = {}
+background_scheduler = None
+
+
+def background_job(name, lease_seconds, run_at_start=False, **trigger):
+    """注册后台任务。lease_seconds 应小于两次触发的间隔、大于 worker 之间的时钟偏差；
+    传 None 表示任务自己调用 acquire_job_lease 管理租约。run_at_start 表示调度器启动时立即执行一次"""
+    def decorator(f):
+        BACKGROUND_JOBS[name] = {'func': f, 'lease_seconds': lease_seconds, 'run_at_start': run_at_start,
+                                 'trigger': trigger}
+        return f
+    return decorator
+
+
+def acquire_job_lease(name, lease_seconds):
+    """抢占任务租约，成功返回 True。租约到期前其他进程的同名任务都会跳过"""
+    now = datetime.utcnow()
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    try:
+        lease = mongo.db.scheduler_leases.find_one_and_update(
+            {'_id': name, '$or': [{'expires_at': {'$lte': now}}, {'owner': owner}]},
+            {'$set': {'owner': owner, 'acquired_at': now, 'expires_at': now + timedelta(seconds=lease_seconds)}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        # 租约被其他进程持有：过滤条件不匹配时 upsert 会和已有的 _id 冲突
+        return False
+    return lease is not None
+
 
-    # 确保events集合存在
-    if 'events' not in mongo.db.list_collection_names():
-        mongo.db.create_collection('events')
-        print("创建events集合")
+def run_background_job(name):
+    job = BACKGROUND_JOBS[name]
+    try:
+        if job['lease_seconds'] and not acquire_job_lease(name, job['lease_seconds']):
+            return
+        started = time.perf_counter()
+        job['func']()
+        print(f"后台任务 {name} 完成，耗时 {time.perf_counter() - started:.1f} 秒")
+    except Exception as e:
+        print(f"后台任务 {name} 出错: {str(e)}")
 
-    # 创建索引以提高性能
-    mongo.db.events.create_index([('datetime', 1)])
-    mongo.db.events.create_index([('organizer_id', 1)])
-    print("创建必要的索引")
-except Exception as e:
-    print(f"连接MongoDB时出错: {str(e)}")
-    print(f"错误类型: {type(e)}")
-    import traceback
 
-    print(f"追踪: {traceback.format_exc()}")
+def start_background_jobs():
+    """在当前进程中启动调度器。gunicorn 在 post_fork 中为每个 worker 调用，重复调用无副作用"""
+    global background_scheduler
+    if background_scheduler is not None or not app.config.get("BACKGROUND_JOBS_ENABLED"):
+        return
+    background_scheduler = BackgroundScheduler(daemon=True)
+    for name, job in BACKGROUND_JOBS.items():
+        # 首次执行时间在调度器启动时计算（gunicorn 在 fork 之后才启动），而不是在导入模块时
+        first_run = {'next_run_time': datetime.now()} if job['run_at_start'] else {}
+        background_scheduler.add_job(run_background_job, args=(name,), id=name,
+                                     coalesce=True, max_instances=1, misfire_grace_time=600,
+                                     **first_run, **job['trigger'])
+    background_scheduler.start()
 
 
 # 登录要求装饰器
@@ -52,6 +324,247 @@ def login_required(f):
     return decorated_function
 
 
+class TTLCache:
+    """线程安全的 LRU 缓存，条目写入 ttl 秒后过期，超过 maxsize 时淘汰最久未使用的条目"""
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires_at = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+# 跨请求的用户文档缓存。每个 worker 各自一份，其他 worker 中的修改最多延迟 ttl 秒可见
+user_cache = TTLCache(maxsize=int(os.environ.get("USER_CACHE_MAXSIZE", 1024)),
+                      ttl=int(os.environ.get("USER_CACHE_TTL_SECONDS", 60)))
+
+
+def get_current_user():
+    """获取当前登录用户的文档：同一请求内缓存在 g 中，跨请求使用 user_cache"""
+    if 'current_user' in g:
+        return g.current_user
+
+    user = None
+    user_id = session.get('user_id')
+    # 管理员账号不在 users 集合中
+    if user_id and user_id != 'admin':
+        user = user_cache.get(user_id)
+        if user is None:
+            user = mongo.db.users.find_one({'_id': ObjectId(user_id)})
+            if user:
+                user_cache.set(user_id, user)
+        if user:
+            # 返回副本，避免路由中的修改污染缓存
+            user = dict(user)
+
+    g.current_user = user
+    return user
+
+
+def invalidate_user_cache(user_id):
+    """用户文档被修改后调用，清除跨请求缓存和本次请求的缓存"""
+    user_cache.pop(str(user_id))
+    g.pop('current_user', None)
+
+
+EVENT_STREAM_COLLECTION = 'event_stream'
+
+
+class EventBroker:
+    """进程内发布/订阅：每个订阅者一个队列，跨 worker 的投递交给可替换的 backend"""
+
+    def __init__(self):
+        self.backend = None
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, channel):
+        subscriber = queue.Queue(maxsize=100)
+        with self._lock:
+            self._subscribers.setdefault(channel, set()).add(subscriber)
+        self.backend.start()
+        return subscriber
+
+    def unsubscribe(self, channel, subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(channel)
+            if subscribers:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._subscribers[channel]
+
+    def publish(self, channel, event, data):
+        self.backend.publish(channel, {'event': event, 'data': data})
+
+    def dispatch(self, channel, message):
+        """把消息投递给本进程内该频道的所有订阅者，队列已满的慢订阅者直接丢弃该消息"""
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(message)
+            except queue.Full:
+                pass
+
+
+class LocalBrokerBackend:
+    """只在当前进程内投递，适合单 worker 或开发服务器"""
+
+    def __init__(self, broker):
+        self.broker = broker
+
+    def start(self):
+        pass
+
+    def publish(self, channel, message):
+        self.broker.dispatch(channel, message)
+
+
+# 重建 tail 游标时往回重读的时长。不同 worker 在同一秒内生成的 ObjectId 之间没有先后顺序
+# （进程随机字节不同），跨机器还有时钟偏差，所以不能用 _id > 最后一条 续读；
+# 改为从更早的时间点按插入顺序（$natural）重读，用最近投递过的 _id 去重
+EVENT_STREAM_RESUME_OVERLAP_SECONDS = 60
+EVENT_STREAM_SEEN_IDS = 10000
+
+
+class CappedCollectionBrokerBackend:
+    """通过 capped 集合跨 worker 投递：发布即插入，每个 worker 用一个线程 tail 该集合"""
+
+    def __init__(self, broker, collection_name):
+        self.broker = broker
+        self.collection_name = collection_name
+        self._thread = None
+        self._lock = threading.Lock()
+        self._resume_from = None
+        self._seen = deque(maxlen=EVENT_STREAM_SEEN_IDS)
+        self._seen_ids = set()
+
+    def start(self):
+        # 第一次有订阅者时才启动 tail 线程，避免在 gunicorn master 中 fork 前创建线程
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._tail, name='event-stream-tail', daemon=True)
+                self._thread.start()
+
+    def publish(self, channel, message):
+        mongo.db[self.collection_name].insert_one({
+            'channel': channel,
+            'message': message,
+            'created_at': datetime.utcnow()
+        })
+
+    def _tail(self):
+        collection = mongo.db[self.collection_name]
+        while True:
+            try:
+                self._tail_once(collection)
+                # 集合为空时游标会立即失效，稍等再重建
+                time.sleep(1)
+            except Exception as e:
+                print(f"监听事件流时出错: {str(e)}")
+                time.sleep(1)
+
+    def _tail_once(self, collection):
+        """建立一个 tail 游标并读到它失效为止"""
+        if self._resume_from is None:
+            # 第一次只接收订阅之后发布的消息：集合中已有的最近消息都标记为已投递
+            self._resume_from = ObjectId.from_datetime(
+                datetime.now(timezone.utc) - timedelta(seconds=EVENT_STREAM_RESUME_OVERLAP_SECONDS))
+            for doc in collection.find({'_id': {'$gte': self._resume_from}}, {'_id': 1}):
+                self._mark_seen(doc['_id'])
+        query = {'_id': {'$gte': self._resume_from}}
+        cursor = collection.find(query, cursor_type=CursorType.TAILABLE_AWAIT).max_await_time_ms(1000)
+        while cursor.alive:
+            for doc in cursor:
+                if doc['_id'] in self._seen_ids:
+                    continue
+                self._mark_seen(doc['_id'])
+                if doc.get('channel'):
+                    self.broker.dispatch(doc['channel'], doc['message'])
+
+    def _mark_seen(self, doc_id):
+        if len(self._seen) == self._seen.maxlen:
+            self._seen_ids.discard(self._seen[0])
+        self._seen.append(doc_id)
+        self._seen_ids.add(doc_id)
+        resume_from = ObjectId.from_datetime(
+            doc_id.generation_time - timedelta(seconds=EVENT_STREAM_RESUME_OVERLAP_SECONDS))
+        if self._resume_from is None or resume_from > self._resume_from:
+            self._resume_from = resume_from
+
+
+event_broker = EventBroker()
+
+
+class StreamSlots:
+    """长连接名额：gthread worker 的线程数是固定的，长连接最多占用 limit 个，
+    其余线程始终留给紧急呼叫、仪表盘等普通请求。名额用完时立即失败，不阻塞请求线程"""
+
+    def __init__(self):
+        self.limit = 0
+        self.in_use = 0
+        self._lock = threading.Lock()
+
+    def configure(self, config):
+        self.limit = max(config["REQUEST_THREADS"] - config["RESERVED_REQUEST_THREADS"], 0)
+
+    def acquire(self):
+        with self._lock:
+            if self.in_use >= self.limit:
+                return False
+            self.in_use += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.in_use -= 1
+
+
+stream_slots = StreamSlots()
+
+
+def ensure_event_stream_collection():
+    """创建事件流使用的 capped 集合，并写入一条占位文档（空集合无法建立 tailable 游标）"""
+    if EVENT_STREAM_COLLECTION not in mongo.db.list_collection_names():
+        mongo.db.create_collection(EVENT_STREAM_COLLECTION, capped=True,
+                                   size=app.config["EVENT_STREAM_CAPPED_BYTES"])
+        print(f"创建 capped 集合 {EVENT_STREAM_COLLECTION}")
+    if mongo.db[EVENT_STREAM_COLLECTION].estimated_document_count() == 0:
+        mongo.db[EVENT_STREAM_COLLECTION].insert_one({'channel': None, 'created_at': datetime.utcnow()})
+
+
+def elder_channel(elder_id):
+    """老年人相关实时事件的频道，所有关联子女订阅同一频道"""
+    return f"elder:{elder_id}"
+
+
 def get_emergency_contact(user):
     """获取紧急联系人信息的辅助函数"""
     emergency_contact = {
@@ -91,7 +604,7 @@ def index():
     print(">>> 收到访问请求！正在处理...")
     if 'user_id' in session:
         try:
-            user = mongo.db.users.find_one({'_id': ObjectId(session['user_id'])})
+            user = get_current_user()
             if user:
                 if user['role'] == 'child':
                     return redirect(url_for('child_dashboard'))
@@ -110,7 +623,7 @@ def index():
 @login_required
 def dashboard():
     try:
-        user = mongo.db.users.find_one({'_id': ObjectId(session['user_id'])})
+        user = get_current_user()
         if not user:
             flash('用户未找到', 'error')
             return redirect(url_for('index'))
@@ -120,30 +633,22 @@ def dashboard():
 
         emergency_contact = get_emergency_contact(user)
 
-        # 获取今日药品
+        # 获取今日药品（按规则展开，排除已服用/跳过的）
         today = datetime.now()
         today_start = datetime.combine(today.date(), datetime.min.time())
-        today_end = datetime.combine(today.date(), datetime.max.time())
 
-        today_medicines = list(mongo.db.medicine_schedule.find({
-            'user_id': ObjectId(session['user_id']),
-            'date': {
-                '$gte': today_start,
-                '$lte': today_end
-            },
-            'is_taken': False
-        }).sort('time', 1))
+        today_medicines = [
+            dose for dose in get_medicine_doses(ObjectId(session['user_id']), today_start,
+                                                today_start + timedelta(days=1))
+            if dose['status'] == 'pending'
+        ]
 
-        # 获取即将到来的提醒（未来3天）
-        three_days_later = today + timedelta(days=3)
+        # 获取即将到来的提醒（今天起4个自然日内）
         upcoming_reminders = list(mongo.db.reminders.find({
             'user_id': ObjectId(session['user_id']),
             'completed': False,
-            'date': {
-                '$gte': today.strftime('%Y-%m-%d'),
-                '$lte': three_days_later.strftime('%Y-%m-%d')
-            }
-        }).sort([('date', 1), ('time', 1)]))
+            'due_at': {'$gte': today_start, '$lt': today_start + timedelta(days=4)}
+        }).sort('due_at', 1))
 
         # 获取即将到期的账单（未来7天）
         seven_days_later = today + timedelta(days=7)
@@ -168,92 +673,93 @@ def dashboard():
         return redirect(url_for('index'))
 
 
+# 仪表盘并发查询使用的有界线程池，所有请求共享，避免为每个请求创建线程
+dashboard_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("DASHBOARD_QUERY_WORKERS", 8)),
+                                        thread_name_prefix='dashboard-query')
+
+
+def run_queries_concurrently(queries):
+    """在线程池中并发执行 {名称: 无参函数}，返回 (结果字典, 各查询耗时毫秒字典)"""
+    def timed(query):
+        start = time.perf_counter()
+        result = query()
+        return result, (time.perf_counter() - start) * 1000
+
+    started = time.perf_counter()
+    futures = {name: dashboard_executor.submit(timed, query) for name, query in queries.items()}
+    results, timings = {}, {}
+    for name, future in futures.items():
+        results[name], timings[name] = future.result()
+    timings['total'] = (time.perf_counter() - started) * 1000
+
+    print("并发查询耗时: " + ", ".join(f"{name}={ms:.1f}ms" for name, ms in timings.items()))
+    return results, timings
+
+
+def server_timing_header(timings):
+    """把查询耗时格式化为 Server-Timing 响应头，可在浏览器开发者工具中查看"""
+    return ", ".join(f"{name};dur={ms:.1f}" for name, ms in timings.items())
+
+
 @app.route('/cd')
 @login_required
 def child_dashboard():
     try:
-        user = mongo.db.users.find_one({'_id': ObjectId(session['user_id'])})
+        user = get_current_user()
         if not user or user['role'] != 'child':
             flash('访问被拒绝', 'error')
             return redirect(url_for('index'))
 
         # 获取关联的老年人信息
-        linked_elder = None
         if user.get('elder_id'):
-            linked_elder = mongo.db.users.find_one({'_id': ObjectId(user['elder_id'])})
-
-            if linked_elder:
+            elder_id = ObjectId(user['elder_id'])
+            today = datetime.now()
+            today_start = datetime.combine(today.date(), datetime.min.time())
+            one_hour_ago = datetime.utcnow() - timedelta(hours=1)
+            # 页面随后只轮询此时间点之后的变化
+            poll_cursor = next_poll_cursor()
+
+            # 以下查询互不依赖，并发执行，页面耗时约等于最慢的一个查询
+            results, timings = run_queries_concurrently({
+                'linked_elder': lambda: mongo.db.users.find_one({'_id': elder_id}),
                 # 获取老年人的即将到来的活动
-                elder_events = list(mongo.db.events.find({
-                    'participants': ObjectId(user['elder_id'])
-                }).sort('datetime', 1))
-
+                'elder_events': lambda: list(mongo.db.events.find({
+                    'participants': elder_id
+                }).sort('datetime', 1)),
                 # 获取老年人的今日药品
-                today = datetime.now()
-                today_start = datetime.combine(today.date(), datetime.min.time())
-                today_end = datetime.combine(today.date(), datetime.max.time())
-
-                today_medicines = list(mongo.db.medicine_schedule.find({
-                    'user_id': ObjectId(user['elder_id']),
-                    'date': {
-                        '$gte': today_start,
-                        '$lte': today_end
-                    }
-                }).sort('time', 1))
-
+                'today_medicines': lambda: get_medicine_doses(elder_id, today_start,
+                                                              today_start + timedelta(days=1)),
                 # 获取老年人的近期提醒
-                elder_reminders = list(mongo.db.reminders.find({
-                    'user_id': ObjectId(user['elder_id']),
+                'elder_reminders': lambda: list(mongo.db.reminders.find({
+                    'user_id': elder_id,
                     'completed': False
-                }).sort('date', 1).limit(5))
-
-                # 获取老年人的财务摘要
-                finance_summary = {
-                    'total_monthly_expenses': 0,
-                    'total_paid_expenses': 0,
-                    'pending_fixed_total': 0
-                }
-
-                # 计算常规支出
-                regular_expenses = list(mongo.db.regular_expenses.find({
-                    'user_id': ObjectId(user['elder_id']),
-                    'date': {
-                        '$gte': today_start,
-                        '$lte': today_end
-                    }
-                }))
-
-                finance_summary['total_monthly_expenses'] = sum(expense['amount'] for expense in regular_expenses)
-
-                # 计算固定支出
-                fixed_expenses = list(mongo.db.fixed_expenses.find({
-                    'user_id': ObjectId(user['elder_id'])
-                }))
-
-                paid_fixed = sum(expense['amount'] for expense in fixed_expenses if expense.get('is_paid', False))
-                total_fixed = sum(expense['amount'] for expense in fixed_expenses)
-
-                finance_summary['total_paid_expenses'] = finance_summary['total_monthly_expenses'] + paid_fixed
-                finance_summary['pending_fixed_total'] = total_fixed - paid_fixed
-
+                }).sort('due_at', 1).limit(5)),
+                # 获取老年人本月的财务摘要（月度汇总和固定支出汇总的单点查询）
+                'rollup': lambda: get_finance_rollup(elder_id, today),
+                'fixed_totals': lambda: get_fixed_expense_totals(elder_id),
                 # 获取关联老年人最近一小时的紧急日志
-                one_hour_ago = datetime.utcnow() - timedelta(hours=1)
-                emergency_logs = list(mongo.db.emergency_logs.find({
-                    'user_id': ObjectId(user['elder_id']),
+                'emergency_logs': lambda: list(mongo.db.emergency_logs.find({
+                    'user_id': elder_id,
                     'created_at': {'$gte': one_hour_ago}
-                }).sort('created_at', -1))
+                }).sort('created_at', -1)),
+            })
 
-                # 清理旧的紧急日志
-                cleanup_old_emergency_logs()
+            if results['linked_elder']:
+                rollup = results.pop('rollup')
+                fixed_totals = results.pop('fixed_totals')
+                finance_summary = {
+                    'total_monthly_expenses': rollup['regular_total'],
+                    'total_paid_expenses': round(rollup['regular_total'] + fixed_totals['paid_total'], 2),
+                    'pending_fixed_total': round(fixed_totals['total'] - fixed_totals['paid_total'], 2)
+                }
 
-                return render_template('child_dashboard.html',
-                                       user=user,
-                                       linked_elder=linked_elder,
-                                       elder_events=elder_events,
-                                       today_medicines=today_medicines,
-                                       elder_reminders=elder_reminders,
-                                       finance_summary=finance_summary,
-                                       emergency_logs=emergency_logs)
+                response = make_response(render_template('child_dashboard.html',
+                                                         user=user,
+                                                         finance_summary=finance_summary,
+                                                         poll_cursor=poll_cursor,
+                                                         **results))
+                response.headers['Server-Timing'] = server_timing_header(timings)
+                return response
 
         return render_template('child_dashboard.html',
                                user=user,
@@ -265,17 +771,122 @@ def child_dashboard():
         return redirect(url_for('index'))
 
 
-def cleanup_old_emergency_logs():
-    """清理超过一小时的紧急日志"""
+POLL_CURSOR_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+# 游标往回留出的重叠时间：写入方在游标之前打上 updated_at/created_at、但在本次查询之后才提交的数据，
+# 以及 worker 之间的时钟偏差，都由这段重叠兜住。重叠部分会重复返回，前端按 _id 覆盖，没有副作用
+POLL_CURSOR_OVERLAP_SECONDS = 10
+
+
+def next_poll_cursor():
+    return (datetime.utcnow() - timedelta(seconds=POLL_CURSOR_OVERLAP_SECONDS)).strftime(POLL_CURSOR_FORMAT)
+
+
+@app.route('/cd/updates')
+@login_required
+def child_dashboard_updates():
+    """子女仪表盘增量接口：只返回 since 之后新增的紧急日志、用药状态变化和提醒变化。
+    删除的药品和提醒不会通过这里通知，页面刷新后才会消失"""
+    user = get_current_user()
+    if not user or user['role'] != 'child' or not user.get('elder_id'):
+        return jsonify({'success': False, 'message': '访问被拒绝'}), 403
+
+    try:
+        since = datetime.strptime(request.args.get('since', ''), POLL_CURSOR_FORMAT)
+    except ValueError:
+        return jsonify({'success': False, 'message': '无效的 since 参数'}), 400
+
     try:
-        one_hour_ago = datetime.utcnow() - timedelta(hours=1)
-        result = mongo.db.emergency_logs.delete_many({
-            'created_at': {'$lt': one_hour_ago}
+        # 先确定下一次的游标（往回留出重叠时间），查询期间及之前不久写入的数据下次还会返回一次
+        cursor = next_poll_cursor()
+        elder_id = ObjectId(user['elder_id'])
+        today = datetime.now()
+        today_start = datetime.combine(today.date(), datetime.min.time())
+
+        results, timings = run_queries_concurrently({
+            'emergency_logs': lambda: list(mongo.db.emergency_logs.find(
+                {'user_id': elder_id, 'created_at': {'$gt': since}},
+                {'contact_type': 1, 'created_at': 1}
+            ).sort('created_at', -1)),
+            # 服药状态变化都会写入一条记录，_id 换成页面上使用的 dose_id
+            'medicines': lambda: [
+                dict(record, _id=dose_id(record['medicine_id'], record['date']))
+                for record in mongo.db.medicine_schedule.find(
+                    {'user_id': elder_id, 'updated_at': {'$gt': since},
+                     'date': {'$gte': today_start, '$lt': today_start + timedelta(days=1)}},
+                    {'medicine_id': 1, 'date': 1, 'medicine_name': 1, 'dosage': 1, 'time': 1, 'is_taken': 1}
+                ).sort('date', 1)
+            ],
+            'reminders': lambda: list(mongo.db.reminders.find(
+                {'user_id': elder_id, 'updated_at': {'$gt': since}},
+                {'title': 1, 'date': 1, 'time': 1, 'completed': 1}
+            ).sort('due_at', 1)),
         })
-        if result.deleted_count > 0:
-            print(f"清理了 {result.deleted_count} 条旧的紧急日志")
+
+        response = jsonify(dict(to_json_safe(results), success=True, cursor=cursor))
+        response.headers['Server-Timing'] = server_timing_header(timings)
+        return response
     except Exception as e:
-        print(f"清理紧急日志时出错: {str(e)}")
+        print(f"子女仪表盘增量更新出错: {str(e)}")
+        return jsonify({'success': False, 'message': '获取更新时出错'}), 500
+
+
+def sse_event(event, data):
+    """格式化一条 Server-Sent Events 消息"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.route('/cd/stream')
+@login_required
+def child_dashboard_stream():
+    """子女实时事件流（Server-Sent Events），关联老年人发起紧急呼叫时立即推送"""
+    user = get_current_user()
+    if not user or user['role'] != 'child' or not user.get('elder_id'):
+        return jsonify({'success': False, 'message': '访问被拒绝'}), 403
+
+    # 本 worker 的长连接名额已满时返回 503，页面继续用 /cd/updates 轮询
+    if not stream_slots.acquire():
+        return jsonify({'success': False, 'message': '实时推送连接已满'}), 503, {'Retry-After': '300'}
+
+    channel = elder_channel(user['elder_id'])
+    max_seconds = app.config["SSE_MAX_STREAM_SECONDS"]
+
+    def generate():
+        subscriber = event_broker.subscribe(channel)
+        deadline = time.monotonic() + max_seconds
+        try:
+            yield 'retry: 3000\n\n'
+            while time.monotonic() < deadline:
+                try:
+                    message = subscriber.get(timeout=15)
+                except queue.Empty:
+                    # 注释行作为心跳，防止代理关闭空闲连接
+                    yield ': keep-alive\n\n'
+                    continue
+                yield sse_event(message['event'], message['data'])
+        finally:
+            event_broker.unsubscribe(channel, subscriber)
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # 响应关闭时归还名额；客户端在生成器开始前断开时也会调用
+    response.call_on_close(stream_slots.release)
+    return response
+
+
+EVENTS_PAGE_SIZE = 12
+
+
+def encode_event_cursor(event):
+    """把活动的 (datetime, _id) 编码为分页游标"""
+    return f"{event['datetime'].strftime('%Y%m%d%H%M%S%f')}_{event['_id']}"
+
+
+def decode_event_cursor(cursor):
+    """解析分页游标，格式错误时抛出 ValueError"""
+    datetime_part, _, id_part = cursor.partition('_')
+    if not ObjectId.is_valid(id_part):
+        raise ValueError(f"无效的游标: {cursor}")
+    return datetime.strptime(datetime_part, '%Y%m%d%H%M%S%f'), ObjectId(id_part)
 
 
 @app.route('/social_events')
@@ -286,18 +897,30 @@ def social_events():
         user_id = ObjectId(session['user_id'])
         print(f"为用户ID获取活动: {user_id}")
 
-        # 验证MongoDB连接
-        try:
-            mongo.db.command('ping')
-            print("MongoDB连接正常")
-        except Exception as e:
-            print(f"MongoDB连接错误: {str(e)}")
-            flash('数据库连接错误。请重试。', 'error')
-            return redirect(url_for('dashboard'))
+        now = datetime.now()
 
-        # 获取所有活动，按时间排序
-        events = list(mongo.db.events.find().sort('datetime', 1))
-        print(f"找到的活动总数: {len(events)}")
+        # 只列出未开始的活动，按 (datetime, _id) 做 keyset 分页，每页成本与历史活动数量无关
+        query = {'datetime': {'$gte': now}}
+        after = request.args.get('after')
+        if after:
+            try:
+                after_datetime, after_id = decode_event_cursor(after)
+                query = {'$and': [query, {'$or': [
+                    {'datetime': {'$gt': after_datetime}},
+                    {'datetime': after_datetime, '_id': {'$gt': after_id}}
+                ]}]}
+            except ValueError:
+                after = None
+
+        # 多取一条用于判断是否还有下一页
+        events = list(mongo.db.events.find(query)
+                      .sort([('datetime', 1), ('_id', 1)])
+                      .limit(EVENTS_PAGE_SIZE + 1))
+        next_cursor = None
+        if len(events) > EVENTS_PAGE_SIZE:
+            events = events[:EVENTS_PAGE_SIZE]
+            next_cursor = encode_event_cursor(events[-1])
+        print(f"本页活动数: {len(events)}")
 
         # 获取当前用户组织的活动
         my_events = list(mongo.db.events.find({
@@ -305,11 +928,13 @@ def social_events():
         }).sort('datetime', 1))
         print(f"用户组织的活动数: {len(my_events)}")
 
-        # 获取用户参与的活动
-        user_participating_events = []
-        for event in events:
-            if user_id in event.get('participants', []):
-                user_participating_events.append(str(event['_id']))
+        # 获取用户参与的未开始活动（participants 索引查询，只取 _id）
+        user_participating_events = {
+            event['_id'] for event in mongo.db.events.find(
+                {'participants': user_id, 'datetime': {'$gte': now}},
+                {'_id': 1}
+            )
+        }
         print(f"用户参与的活动数: {len(user_participating_events)}")
 
         # 获取此页面的任何待处理通知
@@ -319,6 +944,8 @@ def social_events():
                                events=events,
                                my_events=my_events,
                                user_participating_events=user_participating_events,
+                               next_cursor=next_cursor,
+                               is_first_page=not after,
                                notifications=notifications)
     except Exception as e:
         print(f"\n社交活动路由错误: {str(e)}")
@@ -374,7 +1001,7 @@ def create_event():
 
         # 获取组织者详情
         user_id = ObjectId(session['user_id'])
-        organizer = mongo.db.users.find_one({'_id': user_id})
+        organizer = get_current_user()
         if not organizer:
             print(f"未找到用户ID的组织者: {session['user_id']}")
             session['social_events_notifications'] = [{'type': 'error', 'message': '未找到用户！'}]
@@ -439,13 +1066,21 @@ def view_event(event_id):
             flash('未找到活动！', 'error')
             return redirect(url_for('social_events'))
 
-        # 获取参与者的详细信息及加入时间
+        # 一次 $in 查询取回所有参与者，只取页面需要的字段
+        participant_users = mongo.db.users.find(
+            {'_id': {'$in': event['participants']}},
+            {'name': 1, 'email': 1}
+        )
+        users_by_id = {user['_id']: user for user in participant_users}
+
+        # 获取参与者的详细信息及加入时间（保持活动中参与者的顺序）
         participants = []
+        join_times = event.get('participant_join_times', {})
         for participant_id in event['participants']:
-            user = mongo.db.users.find_one({'_id': participant_id})
+            user = users_by_id.get(participant_id)
             if user:
                 # 从活动的参与者数组中获取加入时间
-                join_time = event.get('participant_join_times', {}).get(str(participant_id), event['created_at'])
+                join_time = join_times.get(str(participant_id), event['created_at'])
                 participants.append({
                     'name': user['name'],
                     'email': user['email'],
@@ -655,6 +1290,7 @@ def register():
 
         try:
             result = mongo.db.users.insert_one(user)
+            invalidate_user_cache(result.inserted_id)
             flash('注册成功！请登录', 'success')
             return redirect(url_for('login'))
         except Exception as e:
@@ -683,6 +1319,8 @@ def login():
         user = mongo.db.users.find_one({'email': email})
         if user and check_password_hash(user['password_hash'], password):
             session['user_id'] = str(user['_id'])
+            # 登录时已读到完整文档，直接预热缓存，省去下一页的查询
+            user_cache.set(session['user_id'], user)
             session['is_admin'] = False
             session['role'] = user['role']
             flash('登录成功！', 'success')
@@ -703,7 +1341,7 @@ def logout():
 @login_required
 def profile():
     try:
-        user = mongo.db.users.find_one({'_id': ObjectId(session['user_id'])})
+        user = get_current_user()
         if not user:
             flash('未找到用户！', 'error')
             return redirect(url_for('dashboard'))
@@ -807,6 +1445,7 @@ def update_profile():
                 {'_id': user_id},
                 {'$set': update_data}
             )
+            invalidate_user_cache(user_id)
 
             if result.modified_count > 0:
                 session['profile_notifications'] = [{'type': 'success', 'message': '个人资料更新成功！'}]
@@ -833,54 +1472,298 @@ def admin_dashboard():
             flash('访问被拒绝', 'error')
             return redirect(url_for('index'))
 
-        # 获取所有用户
-        users = list(mongo.db.users.find())
+        # 页面只是外壳，各面板展开时再通过 /admin/api/<panel> 分页加载
+        return render_template('admin_dashboard.html')
 
-        # 获取所有活动
-        events = list(mongo.db.events.find().sort('datetime', 1))
-
-        # 获取所有药品计划
-        medicine_schedules = list(mongo.db.medicine_schedule.find().sort('date', 1))
+    except Exception as e:
+        print(f"管理员主界面路由错误: {str(e)}")
+        flash('加载主界面时出错', 'error')
+        return redirect(url_for('index'))
 
-        # 获取所有提醒
-        reminders = list(mongo.db.reminders.find().sort('date', 1))
 
-        # 获取所有常规支出
-        regular_expenses = list(mongo.db.regular_expenses.find().sort('date', 1))
+def parse_bool(value):
+    return value.lower() in ('1', 'true', 'yes')
+
+
+# 管理员面板配置：集合、返回字段、允许的排序字段（及默认方向）和筛选字段（及取值解析函数）。
+# 排序字段列表的第一个为默认排序；resolve_users 表示需要批量补充 user_name。
+ADMIN_PAGE_SIZE = 50
+ADMIN_PANELS = {
+    'users': {
+        'collection': 'users',
+        'projection': {'name': 1, 'email': 1, 'role': 1, 'phone': 1, 'age': 1, 'created_at': 1},
+        'sorts': [('created_at', DESCENDING), ('name', ASCENDING)],
+        'filters': {'role': str},
+    },
+    'events': {
+        'collection': 'events',
+        'projection': {'name': 1, 'datetime': 1, 'location': 1, 'organizer_name': 1, 'max_participants': 1,
+                       'participant_count': {'$size': {'$ifNull': ['$participants', []]}}},
+        'sorts': [('datetime', DESCENDING)],
+        'filters': {'organizer_id': ObjectId},
+    },
+    'medicine_schedules': {
+        'collection': 'medicine_schedule',
+        'projection': {'user_id': 1, 'medicine_name': 1, 'dosage': 1, 'date': 1, 'time': 1, 'is_taken': 1},
+        'sorts': [('date', DESCENDING)],
+        'filters': {'user_id': ObjectId, 'is_taken': parse_bool},
+        'resolve_users': True,
+    },
+    'reminders': {
+        'collection': 'reminders',
+        'projection': {'user_id': 1, 'title': 1, 'date': 1, 'time': 1, 'completed': 1},
+        'sorts': [('date', DESCENDING)],
+        'filters': {'user_id': ObjectId, 'completed': parse_bool},
+        'resolve_users': True,
+    },
+    'regular_expenses': {
+        'collection': 'regular_expenses',
+        'projection': {'user_id': 1, 'name': 1, 'amount': 1, 'category': 1, 'date': 1},
+        'sorts': [('date', DESCENDING), ('amount', DESCENDING)],
+        'filters': {'user_id': ObjectId, 'category': str},
+        'resolve_users': True,
+    },
+    'fixed_expenses': {
+        'collection': 'fixed_expenses',
+        'projection': {'user_id': 1, 'name': 1, 'amount': 1, 'category': 1, 'frequency': 1, 'date': 1,
+                       'is_paid': 1},
+        'sorts': [('date', DESCENDING), ('amount', DESCENDING)],
+        'filters': {'user_id': ObjectId, 'is_paid': parse_bool},
+        'resolve_users': True,
+    },
+    'feedback': {
+        'collection': 'feedback',
+        'projection': {'user_id': 1, 'type': 1, 'rating': 1, 'message': 1, 'status': 1, 'created_at': 1},
+        'sorts': [('created_at', DESCENDING)],
+        'filters': {'status': str, 'type': str},
+        'resolve_users': True,
+    },
+    'tutorial_requests': {
+        'collection': 'tutorial_requests',
+        'projection': {'user_name': 1, 'topic': 1, 'category': 1, 'difficulty': 1, 'platform': 1,
+                       'description': 1, 'additional_notes': 1, 'status': 1, 'admin_notes': 1, 'created_at': 1},
+        'sorts': [('created_at', DESCENDING)],
+        'filters': {'status': str},
+    },
+    'emergency_logs': {
+        'collection': 'emergency_logs',
+        'projection': {'user_name': 1, 'contact_type': 1, 'phone_number': 1, 'linked_child_name': 1,
+                       'created_at': 1},
+        'sorts': [('created_at', DESCENDING)],
+        'filters': {},
+    },
+}
+
+
+def encode_keyset_cursor(values):
+    """把排序键（可包含 datetime/ObjectId）编码为 URL 安全的分页游标"""
+    return base64.urlsafe_b64encode(json_util.dumps(values).encode()).decode()
+
+
+def decode_keyset_cursor(cursor):
+    return json_util.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+
+
+def keyset_after_filter(field, direction, last_value, last_id):
+    """(field, _id) 排序中位于 (last_value, last_id) 之后的条件。
+    缺失或为 null 的字段排在所有值之前（升序）或之后（降序），而 $gt/$lt 不会匹配 null，需要单独处理"""
+    op = '$gt' if direction == ASCENDING else '$lt'
+    if last_value is None:
+        same_null = {field: None, '_id': {op: last_id}}
+        # 降序时 null 已经是最后一段；升序时 null 之后还有所有非 null 的值
+        return same_null if direction == DESCENDING else {'$or': [same_null, {field: {'$ne': None}}]}
+    branches = [{field: {op: last_value}}, {field: last_value, '_id': {op: last_id}}]
+    if direction == DESCENDING:
+        branches.append({field: None})
+    return {'$or': branches}
+
+
+def to_json_safe(value):
+    """把 ObjectId、datetime 转换为字符串，便于 jsonify"""
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M')
+    if isinstance(value, list):
+        return [to_json_safe(item) for item in value]
+    if isinstance(value, dict):
+        return {key: to_json_safe(item) for key, item in value.items()}
+    return value
+
+
+@app.route('/admin/api/<panel>')
+@login_required
+def admin_panel_api(panel):
+    if not session.get('is_admin'):
+        return jsonify({'error': '未授权'}), 403
 
-        # 获取所有固定支出
-        fixed_expenses = list(mongo.db.fixed_expenses.find())
+    config = ADMIN_PANELS.get(panel)
+    if not config:
+        return jsonify({'error': '未知的面板'}), 404
 
-        # 获取所有反馈项
-        feedback_items = list(mongo.db.feedback.find().sort('created_at', -1))
+    try:
+        # 排序：只允许配置中的字段，order 可覆盖默认方向
+        sorts = dict(config['sorts'])
+        sort_field = request.args.get('sort', config['sorts'][0][0])
+        if sort_field not in sorts:
+            return jsonify({'error': '不支持的排序字段'}), 400
+        direction = sorts[sort_field]
+        if request.args.get('order') in ('asc', 'desc'):
+            direction = ASCENDING if request.args['order'] == 'asc' else DESCENDING
+
+        # 筛选：只接受配置中声明的字段
+        query = {}
+        for field, parse in config['filters'].items():
+            if request.args.get(field):
+                query[field] = parse(request.args[field])
+
+        # keyset 分页：从上一页最后一条的 (排序字段, _id) 之后继续
+        if request.args.get('after'):
+            last_value, last_id = decode_keyset_cursor(request.args['after'])
+            query = {'$and': [query, keyset_after_filter(sort_field, direction, last_value, last_id)]}
+
+        limit = min(int(request.args.get('limit', ADMIN_PAGE_SIZE)), 200)
+        projection = dict(config['projection'])
+        projection[sort_field] = 1
+        items = list(mongo.db[config['collection']]
+                     .find(query, projection)
+                     .sort([(sort_field, direction), ('_id', direction)])
+                     .limit(limit + 1))
+
+        next_cursor = None
+        if len(items) > limit:
+            items = items[:limit]
+            next_cursor = encode_keyset_cursor([items[-1].get(sort_field), items[-1]['_id']])
+
+        # 本页涉及的用户一次 $in 查询取回姓名
+        if config.get('resolve_users'):
+            user_ids = list({item['user_id'] for item in items if item.get('user_id')})
+            names = {user['_id']: user['name']
+                     for user in mongo.db.users.find({'_id': {'$in': user_ids}}, {'name': 1})}
+            for item in items:
+                item['user_name'] = names.get(item.get('user_id'), '未知用户')
 
-        # 获取所有教程请求
-        tutorial_requests = list(mongo.db.tutorial_requests.find().sort('created_at', -1))
+        return jsonify({
+            'items': to_json_safe(items),
+            'next_cursor': next_cursor
+        })
+    except (ValueError, TypeError, InvalidId):
+        return jsonify({'error': '无效的查询参数'}), 400
+    except Exception as e:
+        print(f"管理员面板 {panel} 加载出错: {str(e)}")
+        return jsonify({'error': str(e)}), 500
 
-        # 获取最近一小时的紧急日志
-        one_hour_ago = datetime.utcnow() - timedelta(hours=1)
-        emergency_logs = list(mongo.db.emergency_logs.find({
-            'created_at': {'$gte': one_hour_ago}
-        }).sort('created_at', -1))
 
-        # 清理旧的紧急日志
-        cleanup_old_emergency_logs()
+def count_lookup(collection, pipeline):
+    """$facet 子管道：对另一个集合执行 pipeline 并把结果放进 result 数组"""
+    return [
+        {'$limit': 1},
+        {'$lookup': {'from': collection, 'pipeline': pipeline, 'as': 'result'}},
+        {'$project': {'_id': 0, 'result': 1}}
+    ]
+
+
+def scheduled_doses_expr(start, end):
+    """medicines 文档上的聚合表达式：按 days × times 规则计算 [start, end) 内应服药的次数"""
+    terms = []
+    day = start.date()
+    while day <= end.date():
+        day_start = datetime.combine(day, datetime.min.time())
+        # times 是 HH:MM 字符串，按字典序比较即可；首尾两天只计算窗口内的时间
+        low = start.strftime('%H:%M') if day == start.date() else '00:00'
+        high = end.strftime('%H:%M') if day == end.date() else '24:00'
+        terms.append({'$cond': [
+            {'$and': [
+                {'$in': [WEEKDAY_NAMES[day.weekday()], {'$ifNull': ['$days', []]}]},
+                {'$lt': [{'$ifNull': ['$start_date', '$created_at']}, day_start + timedelta(days=1)]}
+            ]},
+            {'$size': {'$filter': {
+                'input': {'$ifNull': ['$times', []]},
+                'cond': {'$and': [{'$gte': ['$$this', low]}, {'$lt': ['$$this', high]}]}
+            }}},
+            0
+        ]})
+        day += timedelta(days=1)
+    return {'$add': terms}
+
+
+# 管理员统计结果短暂缓存，反复刷新页面不会重复扫描集合
+admin_stats_cache = TTLCache(maxsize=1, ttl=int(os.environ.get("ADMIN_STATS_CACHE_SECONDS", 30)))
+
+
+@app.route('/admin/api/stats')
+@login_required
+def admin_stats():
+    if not session.get('is_admin'):
+        return jsonify({'error': '未授权'}), 403
 
-        return render_template('admin_dashboard.html',
-                               users=users,
-                               events=events,
-                               medicine_schedules=medicine_schedules,
-                               reminders=reminders,
-                               regular_expenses=regular_expenses,
-                               fixed_expenses=fixed_expenses,
-                               feedback_items=feedback_items,
-                               tutorial_requests=tutorial_requests,
-                               emergency_logs=emergency_logs)
+    stats = admin_stats_cache.get('stats')
+    if stats is not None:
+        return jsonify(stats)
 
+    try:
+        now = datetime.now()
+        week_ago = now - timedelta(days=7)
+
+        # 一次聚合得到所有需要精确计算的指标：角色分布在 users 上分组，
+        # 其他集合通过无关联的 $lookup 子管道计数（都能命中索引）
+        facets = next(mongo.db.users.aggregate([
+            {'$facet': {
+                'roles': [{'$group': {'_id': '$role', 'count': {'$sum': 1}}}],
+                'active_events': count_lookup('events', [
+                    {'$match': {'datetime': {'$gte': now}}},
+                    {'$count': 'count'}
+                ]),
+                # 应服次数由药品规则计算，已服次数来自稀疏的服用记录
+                'adherence_scheduled': count_lookup('medicines', [
+                    {'$group': {'_id': None, 'total': {'$sum': scheduled_doses_expr(week_ago, now)}}}
+                ]),
+                'adherence_taken': count_lookup('medicine_schedule', [
+                    {'$match': {'date': {'$gte': week_ago, '$lt': now}, 'is_taken': True}},
+                    {'$count': 'count'}
+                ]),
+                'pending_feedback': count_lookup('feedback', [
+                    {'$match': {'status': 'pending'}},
+                    {'$count': 'count'}
+                ]),
+                'pending_tutorial_requests': count_lookup('tutorial_requests', [
+                    {'$match': {'status': 'pending'}},
+                    {'$count': 'count'}
+                ]),
+            }}
+        ]), {})
+
+        def lookup_result(name):
+            rows = facets.get(name) or [{}]
+            result = rows[0].get('result') or [{}]
+            return result[0]
+
+        users_by_role = {row['_id'] or 'unknown': row['count'] for row in facets.get('roles', [])}
+        scheduled = lookup_result('adherence_scheduled').get('total', 0)
+        taken = lookup_result('adherence_taken').get('count', 0)
+        # 规则修改过的药品可能出现已服次数多于应服次数，封顶为 100%
+        adherence_rate = min(round(taken * 100 / scheduled, 1), 100.0) if scheduled else None
+
+        stats = {
+            'users_by_role': users_by_role,
+            'total_users': sum(users_by_role.values()),
+            'active_events': lookup_result('active_events').get('count', 0),
+            'medicine_adherence_7d': adherence_rate,
+            'pending_feedback': lookup_result('pending_feedback').get('count', 0),
+            'pending_tutorial_requests': lookup_result('pending_tutorial_requests').get('count', 0),
+            # 总量只用于展示，使用集合元数据估算，不扫描文档
+            'totals': {
+                name: mongo.db[name].estimated_document_count()
+                for name in ('events', 'feedback', 'tutorial_requests', 'reminders',
+                             'regular_expenses', 'fixed_expenses')
+            },
+            'generated_at': now.strftime('%Y-%m-%d %H:%M:%S')
+        }
+        admin_stats_cache.set('stats', stats)
+        return jsonify(stats)
     except Exception as e:
-        print(f"管理员主界面路由错误: {str(e)}")
-        flash('加载主界面时出错', 'error')
-        return redirect(url_for('index'))
+        print(f"管理员统计出错: {str(e)}")
+        return jsonify({'error': str(e)}), 500
 
 
 @app.route('/admin/user/<user_id>')
@@ -917,6 +1800,47 @@ def admin_user_details(user_id):
         return redirect(url_for('admin_dashboard'))
 
 
+@app.route('/admin/emergency_logs/history')
+@login_required
+def admin_emergency_log_history():
+    if not session.get('is_admin'):
+        return jsonify({'error': '未授权'}), 403
+
+    if not app.config["EMERGENCY_LOG_ARCHIVE"]:
+        return jsonify({'error': '未启用紧急日志归档'}), 404
+
+    try:
+        query = {}
+        if request.args.get('user_id'):
+            query['user_id'] = ObjectId(request.args['user_id'])
+
+        # 日期范围：start/end 格式为 YYYY-MM-DD，end 包含当天
+        date_range = {}
+        if request.args.get('start'):
+            date_range['$gte'] = datetime.strptime(request.args['start'], '%Y-%m-%d')
+        if request.args.get('end'):
+            date_range['$lt'] = datetime.strptime(request.args['end'], '%Y-%m-%d') + timedelta(days=1)
+        if date_range:
+            query['created_at'] = date_range
+
+        limit = min(int(request.args.get('limit', 100)), 500)
+        logs = list(mongo.db.emergency_logs_archive.find(query).sort('created_at', -1).limit(limit))
+
+        for log in logs:
+            log['_id'] = str(log['_id'])
+            log['user_id'] = str(log['user_id'])
+            if 'linked_child_id' in log:
+                log['linked_child_id'] = str(log['linked_child_id'])
+            log['created_at'] = log['created_at'].strftime('%Y-%m-%d %H:%M')
+
+        return jsonify({'count': len(logs), 'logs': logs})
+    except (ValueError, InvalidId):
+        return jsonify({'error': '无效的查询参数'}), 400
+    except Exception as e:
+        print(f"查询紧急日志历史时出错: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+
 @app.route('/admin/feedback/update/<feedback_id>', methods=['POST'])
 def admin_update_feedback(feedback_id):
     if not session.get('is_admin'):
@@ -1022,27 +1946,33 @@ def admin_feedback():
         return redirect(url_for('dashboard'))
 
     try:
-        # 获取所有反馈及用户详情
-        feedback_list = list(mongo.db.feedback.find().sort('created_at', -1))
-
-        # 为每个反馈添加用户详情
-        for feedback in feedback_list:
-            user = mongo.db.users.find_one({'_id': feedback['user_id']})
-            feedback['user_name'] = user['name'] if user else '未知用户'
-
-            # 确保包含评分
-            if 'rating' not in feedback:
-                feedback['rating'] = None
-            else:
-                feedback['rating'] = int(feedback['rating'])
-
-            # 将ObjectId转换为字符串以便JSON序列化
-            feedback['_id'] = str(feedback['_id'])
-            feedback['user_id'] = str(feedback['user_id'])
-
-            # 格式化日期时间
-            if isinstance(feedback.get('created_at'), datetime):
-                feedback['created_at'] = feedback['created_at'].strftime('%Y-%m-%d %H:%M')
+        # 一次聚合完成：关联提交用户姓名、转换ObjectId、格式化日期
+        feedback_list = list(mongo.db.feedback.aggregate([
+            {'$sort': {'created_at': -1}},
+            {'$lookup': {
+                'from': 'users',
+                'let': {'user_id': '$user_id'},
+                'pipeline': [
+                    {'$match': {'$expr': {'$eq': ['$_id', '$$user_id']}}},
+                    {'$project': {'name': 1}}
+                ],
+                'as': 'author'
+            }},
+            {'$addFields': {
+                'user_name': {'$ifNull': [{'$arrayElemAt': ['$author.name', 0]}, '未知用户']},
+                # 缺少评分或无法转换时为 None
+                'rating': {'$convert': {'input': '$rating', 'to': 'int', 'onError': None, 'onNull': None}},
+                '_id': {'$toString': '$_id'},
+                'user_id': {'$toString': '$user_id'},
+                # 只格式化日期类型，缺失或其他类型的 created_at 原样保留，不能让整个聚合失败
+                'created_at': {'$cond': [
+                    {'$eq': [{'$type': '$created_at'}, 'date']},
+                    {'$dateToString': {'format': '%Y-%m-%d %H:%M', 'date': '$created_at'}},
+                    '$created_at'
+                ]}
+            }},
+            {'$project': {'author': 0}}
+        ]))
 
         print(f"调试 - 第一个反馈项: {feedback_list[0] if feedback_list else '未找到反馈'}")
 
@@ -1093,7 +2023,7 @@ def update_feedback_status(feedback_id):
 @app.route('/learning-corner')
 @login_required
 def learning_corner():
-    user = mongo.db.users.find_one({'_id': ObjectId(session['user_id'])})
+    user = get_current_user()
 
     # 获取用户的教程请求
     user_requests = list(mongo.db.tutorial_requests.find(
@@ -1108,42 +2038,42 @@ def learning_corner():
 @app.route('/learning-corner/whatsapp')
 @login_required
 def whatsapp_guide():
-    user = mongo.db.users.find_one({'_id': ObjectId(session['user_id'])})
+    user = get_current_user()
     return render_template('guides/whatsapp_guide.html', user=user)
 
 
 @app.route('/learning-corner/youtube')
 @login_required
 def youtube_guide():
-    user = mongo.db.users.find_one({'_id': ObjectId(session['user_id'])})
+    user = get_current_user()
     return render_template('guides/youtube_guide.html', user=user)
 
 
 @app.route('/learning-corner/payments')
 @login_required
 def payments_guide():
-    user = mongo.db.users.find_one({'_id': ObjectId(session['user_id'])})
+    user = get_current_user()
     return render_template('guides/payments_guide.html', user=user)
 
 
 @app.route('/learning-corner/social-media')
 @login_required
 def social_media_guide():
-    user = mongo.db.users.find_one({'_id': ObjectId(session['user_id'])})
+    user = get_current_user()
     return render_template('guides/social_media_guide.html', user=user)
 
 
 @app.route('/learning-corner/smartphone')
 @login_required
 def smartphone_guide():
-    user = mongo.db.users.find_one({'_id': ObjectId(session['user_id'])})
+    user = get_current_user()
     return render_template('guides/smartphone_guide.html', user=user)
 
 
 @app.route('/learning-corner/video-calls')
 @login_required
 def video_calls_guide():
-    user = mongo.db.users.find_one({'_id': ObjectId(session['user_id'])})
+    user = get_current_user()
     return render_template('guides/video_calls_guide.html', user=user)
 
 
@@ -1160,7 +2090,7 @@ def submit_tutorial_request():
         additional_notes = request.form.get('additional_notes')
 
         # 获取用户详情
-        user = mongo.db.users.find_one({'_id': ObjectId(session['user_id'])})
+        user = get_current_user()
         if not user:
             return jsonify({'success': False, 'message': '未找到用户'}), 404
 
@@ -1286,76 +2216,220 @@ def update_tutorial_request(request_id):
         return jsonify({'success': False, 'message': str(e)}), 500
 
 
+def month_range(day):
+    """返回 day 所在月份的 [第一天 00:00, 下月第一天 00:00) 区间"""
+    first_day = day.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    next_month = (first_day + timedelta(days=32)).replace(day=1)
+    return first_day, next_month
+
+
+# 月度财务汇总：每个 (user_id, month) 一条常规支出文档，支出增删改时用 $inc 原子更新，
+# 汇总页面只需一次点查询。
+FINANCE_ROLLUP_DEFAULTS = {
+    'regular_total': 0,
+    'regular_count': 0,
+    'categories': {},
+}
+# 固定支出是周期性的，不按到期月份汇总：每个用户一条 fixed_expense_totals 文档（_id 为 user_id）。
+# 口径与 /fixed-expenses 页面一致：monthly_total 只计 frequency 为 monthly 的支出，
+# total 和 paid_total 计入所有频率的支出。
+FIXED_EXPENSE_TOTALS_DEFAULTS = {
+    'monthly_total': 0,
+    'total': 0,
+    'paid_total': 0,
+    'count': 0,
+}
+
+
+def month_key(date):
+    """日期所属月份的汇总键，例如 2025-01"""
+    if isinstance(date, str):
+        return date[:7]
+    return date.strftime('%Y-%m')
+
+
+def rollup_category_key(category):
+    """分类名会作为字段名使用，去掉 MongoDB 字段名中不允许的字符"""
+    return (category or '未分类').replace('.', '_').lstrip('$') or '未分类'
+
+
+def regular_expense_rollup_inc(expense, sign=1):
+    amount = sign * expense['amount']
+    return {
+        'regular_total': amount,
+        'regular_count': sign,
+        f"categories.{rollup_category_key(expense.get('category'))}": amount
+    }
+
+
+def fixed_expense_totals_inc(expense, sign=1):
+    amount = sign * expense['amount']
+    inc = {'total': amount, 'count': sign}
+    if expense.get('frequency') == 'monthly':
+        inc['monthly_total'] = amount
+    if expense.get('is_paid'):
+        inc['paid_total'] = amount
+    return inc
+
+
+def inc_finance_rollup(user_id, date, inc):
+    """原子地累加某用户某月的汇总字段，汇总文档不存在时自动创建"""
+    try:
+        mongo.db.finance_rollups.update_one(
+            {'user_id': user_id, 'month': month_key(date)},
+            {'$inc': inc, '$set': {'updated_at': datetime.utcnow()}},
+            upsert=True
+        )
+    except Exception as e:
+        # 汇总失败不影响支出本身的写入，可通过 rebuild-finance-rollups 修复
+        print(f"更新财务汇总时出错: {str(e)}")
+
+
+def inc_fixed_expense_totals(user_id, inc):
+    """原子地累加某用户的固定支出总额，文档不存在时自动创建"""
+    try:
+        mongo.db.fixed_expense_totals.update_one(
+            {'_id': user_id},
+            {'$inc': inc, '$set': {'updated_at': datetime.utcnow()}},
+            upsert=True
+        )
+    except Exception as e:
+        # 汇总失败不影响支出本身的写入，可通过 rebuild-finance-rollups 修复
+        print(f"更新固定支出汇总时出错: {str(e)}")
+
+
+def get_finance_rollup(user_id, day):
+    """读取某用户 day 所在月份的汇总，金额四舍五入到分，消除浮点累加误差"""
+    rollup = mongo.db.finance_rollups.find_one({'user_id': user_id, 'month': month_key(day)}) or {}
+    result = dict(FINANCE_ROLLUP_DEFAULTS)
+    result.update(rollup)
+    result['regular_total'] = round(result['regular_total'], 2)
+    result['categories'] = {name: round(amount, 2) for name, amount in result['categories'].items()
+                            if round(amount, 2) != 0}
+    return result
+
+
+def get_fixed_expense_totals(user_id):
+    """读取某用户的固定支出总额，金额四舍五入到分"""
+    totals = dict(FIXED_EXPENSE_TOTALS_DEFAULTS)
+    totals.update(mongo.db.fixed_expense_totals.find_one({'_id': user_id}) or {})
+    for field in ('monthly_total', 'total', 'paid_total'):
+        totals[field] = round(totals[field], 2)
+    return totals
+
+
+def rebuild_finance_rollups(user_id=None):
+    """从原始支出记录重新计算 finance_rollups 和 fixed_expense_totals 并覆盖，返回重建的文档数"""
+    match = {'user_id': user_id} if user_id else {}
+    # 旧数据的 date 可能是字符串
+    month_expr = {'$cond': [
+        {'$eq': [{'$type': '$date'}, 'string']},
+        {'$substrCP': ['$date', 0, 7]},
+        {'$dateToString': {'format': '%Y-%m', 'date': '$date'}}
+    ]}
+
+    rollups = {}
+
+    def rollup_for(key):
+        if key not in rollups:
+            rollups[key] = dict(FINANCE_ROLLUP_DEFAULTS, categories={})
+        return rollups[key]
+
+    for row in mongo.db.regular_expenses.aggregate([
+        {'$match': match},
+        {'$group': {
+            '_id': {'user_id': '$user_id', 'month': month_expr, 'category': '$category'},
+            'total': {'$sum': '$amount'},
+            'count': {'$sum': 1}
+        }}
+    ]):
+        rollup = rollup_for((row['_id']['user_id'], row['_id']['month']))
+        rollup['regular_total'] += row['total']
+        rollup['regular_count'] += row['count']
+        category = rollup_category_key(row['_id'].get('category'))
+        rollup['categories'][category] = rollup['categories'].get(category, 0) + row['total']
+
+    # 固定支出按用户汇总，_id 即 user_id
+    fixed_totals = list(mongo.db.fixed_expenses.aggregate([
+        {'$match': match},
+        {'$group': {
+            '_id': '$user_id',
+            'monthly_total': {'$sum': {'$cond': [{'$eq': ['$frequency', 'monthly']}, '$amount', 0]}},
+            'total': {'$sum': '$amount'},
+            'paid_total': {'$sum': {'$cond': [{'$eq': ['$is_paid', True]}, '$amount', 0]}},
+            'count': {'$sum': 1}
+        }}
+    ]))
+
+    # 逐条覆盖写入（不存在则插入），再删除已经没有支出的汇总。不先整体删除，
+    # 这样重建期间支出路由的 $inc upsert 不会与插入冲突，汇总也不会出现短暂的空窗
+    now = datetime.utcnow()
+    if rollups:
+        mongo.db.finance_rollups.bulk_write([
+            ReplaceOne({'user_id': key[0], 'month': key[1]},
+                       dict(rollup, user_id=key[0], month=key[1], updated_at=now), upsert=True)
+            for key, rollup in rollups.items()
+        ], ordered=False)
+    stale = [doc['_id'] for doc in mongo.db.finance_rollups.find(match, {'user_id': 1, 'month': 1})
+             if (doc['user_id'], doc['month']) not in rollups]
+    if stale:
+        mongo.db.finance_rollups.delete_many({'_id': {'$in': stale}})
+
+    if fixed_totals:
+        mongo.db.fixed_expense_totals.bulk_write([
+            ReplaceOne({'_id': totals['_id']}, dict(totals, updated_at=now), upsert=True)
+            for totals in fixed_totals
+        ], ordered=False)
+    if user_id:
+        if not fixed_totals:
+            mongo.db.fixed_expense_totals.delete_one({'_id': user_id})
+    else:
+        mongo.db.fixed_expense_totals.delete_many({'_id': {'$nin': [totals['_id'] for totals in fixed_totals]}})
+    return len(rollups) + len(fixed_totals)
+
+
 @app.route('/finance-management')
 @login_required
 def finance_management():
     try:
         user_id = ObjectId(session['user_id'])
 
-        # 获取当前月份的日期
         today = datetime.now()
-        first_day = today.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        last_day = (today.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
-        days_in_month = (last_day - first_day).days + 1
-
-        # 获取当前月份的常规支出
-        regular_expenses = list(mongo.db.regular_expenses.find({
-            'user_id': user_id,
-            'date': {
-                '$gte': first_day,
-                '$lte': last_day
-            }
-        }).sort('date', -1))
-
-        # 计算常规支出总额
-        regular_total = sum(expense['amount'] for expense in regular_expenses)
-        paid_regular_total = sum(expense['amount'] for expense in regular_expenses)
-        pending_regular_total = 0  # 所有常规支出视为已支付
-        daily_regular_average = round(regular_total / days_in_month, 2)
-
-        # 获取固定支出
-        fixed_expenses = list(mongo.db.fixed_expenses.find({
-            'user_id': user_id
-        }).sort('date', 1))
-
-        # 计算固定支出总额
-        fixed_total = sum(expense['amount'] for expense in fixed_expenses if expense['frequency'] == 'monthly')
-        paid_fixed_total = sum(expense['amount'] for expense in fixed_expenses if expense.get('is_paid', False))
-        pending_fixed_total = fixed_total - paid_fixed_total
-        daily_fixed_average = round(fixed_total / days_in_month, 2)
-
-        # 计算月度总支出
-        total_monthly_expenses = regular_total + fixed_total
-        total_paid_expenses = paid_regular_total + paid_fixed_total
+        first_day, next_month = month_range(today)
+        days_in_month = (next_month - first_day).days
+
+        # 本月常规支出来自月度汇总，固定支出来自用户的固定支出汇总，各一次点查询
+        rollup = get_finance_rollup(user_id, today)
+        fixed_totals = get_fixed_expense_totals(user_id)
+        regular_total = rollup['regular_total']
+        fixed_total = fixed_totals['monthly_total']
+        paid_fixed_total = fixed_totals['paid_total']
+
+        summary = {
+            'regular_total': regular_total,
+            'fixed_total': fixed_total,
+            # 所有常规支出视为已支付
+            'paid_regular_total': regular_total,
+            'paid_fixed_total': paid_fixed_total,
+            'pending_regular_total': 0,
+            'pending_fixed_total': round(fixed_total - paid_fixed_total, 2),
+            'daily_regular_average': round(regular_total / days_in_month, 2),
+            'daily_fixed_average': round(fixed_total / days_in_month, 2),
+            'total_monthly_expenses': round(regular_total + fixed_total, 2),
+            'total_paid_expenses': round(regular_total + paid_fixed_total, 2),
+        }
 
-        # 获取最近支付的常规支出（最近5条）
-        paid_regular_expenses = list(mongo.db.regular_expenses.find({
+        # 最近支付的常规支出和固定支出（各5条）
+        summary['paid_regular_expenses'] = list(mongo.db.regular_expenses.find({
             'user_id': user_id,
-            'date': {
-                '$gte': first_day,
-                '$lte': last_day
-            }
+            'date': {'$gte': first_day, '$lt': next_month}
         }).sort('date', -1).limit(5))
-
-        # 获取最近支付的固定支出（最近5条）
-        paid_fixed_expenses = list(mongo.db.fixed_expenses.find({
+        summary['paid_fixed_expenses'] = list(mongo.db.fixed_expenses.find({
             'user_id': user_id,
             'is_paid': True
         }).sort('paid_at', -1).limit(5))
 
-        return render_template('finance_management.html',
-                               regular_total=regular_total,
-                               fixed_total=fixed_total,
-                               paid_regular_total=paid_regular_total,
-                               paid_fixed_total=paid_fixed_total,
-                               pending_regular_total=pending_regular_total,
-                               pending_fixed_total=pending_fixed_total,
-                               daily_regular_average=daily_regular_average,
-                               daily_fixed_average=daily_fixed_average,
-                               total_monthly_expenses=total_monthly_expenses,
-                               total_paid_expenses=total_paid_expenses,
-                               paid_regular_expenses=paid_regular_expenses,
-                               paid_fixed_expenses=paid_fixed_expenses)
+        return render_template('finance_management.html', **summary)
     except Exception as e:
         print(f"财务管理错误: {str(e)}")
         flash('加载财务管理页面时出错', 'error')
@@ -1370,47 +2444,36 @@ def regular_expenses():
 
         # 获取当前月份的支出
         today = datetime.now()
-        first_day = today.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        last_day = (today.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+        first_day, next_month = month_range(today)
 
         # 获取当前月份的所有常规支出
         expenses = list(mongo.db.regular_expenses.find({
             'user_id': user_id,
             'date': {
                 '$gte': first_day,
-                '$lte': last_day
+                '$lt': next_month
             }
         }).sort('date', -1))
 
-        # 计算月度总额
-        monthly_total = sum(expense['amount'] for expense in expenses)
+        # 月度总额和分类总额来自月度汇总
+        rollup = get_finance_rollup(user_id, today)
+        monthly_total = rollup['regular_total']
 
         # 计算日均支出
-        days_in_month = (last_day - first_day).days + 1
+        days_in_month = (next_month - first_day).days
         daily_average = round(monthly_total / days_in_month, 2)
 
-        # 计算分类总额用于饼图
-        category_totals = {}
-        for expense in expenses:
-            category = expense['category']
-            if category not in category_totals:
-                category_totals[category] = 0
-            category_totals[category] += expense['amount']
-
-        # 将分类总额转换为图表所需的列表格式
-        category_data = [
-            {'category': category, 'amount': amount}
-            for category, amount in category_totals.items()
-        ]
-
-        # 按金额排序分类（从高到低）
-        category_data.sort(key=lambda x: x['amount'], reverse=True)
+        # 分类总额转换为饼图所需的列表格式，按金额从高到低排序
+        category_data = sorted(
+            ({'category': category, 'amount': amount} for category, amount in rollup['categories'].items()),
+            key=lambda x: x['amount'], reverse=True
+        )
 
         # 找出最高支出分类
-        highest_category = max(category_totals.items(), key=lambda x: x[1])[0] if category_totals else "无支出"
+        highest_category = category_data[0]['category'] if category_data else "无支出"
 
-        # 获取用户的月度预算
-        user = mongo.db.users.find_one({'_id': user_id})
+        # 获取用户的月度预算（只取预算字段）
+        user = mongo.db.users.find_one({'_id': user_id}, {'monthly_budget': 1}) or {}
         monthly_budget = user.get('monthly_budget', 0)
         remaining_budget = monthly_budget - monthly_total
 
@@ -1428,6 +2491,44 @@ def regular_expenses():
         return redirect(url_for('finance_management'))
 
 
+def expense_category_breakdown(user_id, start, end, categories=None):
+    """在数据库端按分类汇总 [start, end) 区间内的常规支出，按金额从高到低返回"""
+    match = {'user_id': user_id, 'date': {'$gte': start, '$lt': end}}
+    if categories:
+        match['category'] = {'$in': categories}
+    return list(mongo.db.regular_expenses.aggregate([
+        {'$match': match},
+        {'$group': {'_id': '$category', 'amount': {'$sum': '$amount'}}},
+        {'$sort': {'amount': -1}},
+        {'$project': {'_id': 0, 'category': '$_id', 'amount': {'$round': ['$amount', 2]}}}
+    ]))
+
+
+@app.route('/api/expense-categories')
+@login_required
+def expense_categories_api():
+    """饼图数据接口：?start=YYYY-MM-DD&end=YYYY-MM-DD&category=...，end 包含当天，默认本月"""
+    try:
+        user_id = ObjectId(session['user_id'])
+        start, end = month_range(datetime.now())
+        if request.args.get('start'):
+            start = datetime.strptime(request.args['start'], '%Y-%m-%d')
+        if request.args.get('end'):
+            end = datetime.strptime(request.args['end'], '%Y-%m-%d') + timedelta(days=1)
+
+        category_data = expense_category_breakdown(user_id, start, end, request.args.getlist('category'))
+        return jsonify({
+            'success': True,
+            'category_data': category_data,
+            'total_amount': round(sum(item['amount'] for item in category_data), 2)
+        })
+    except ValueError:
+        return jsonify({'success': False, 'message': '无效的日期格式'}), 400
+    except Exception as e:
+        print(f"获取支出分类时出错: {str(e)}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+
 @app.route('/add-regular-expense', methods=['POST'])
 @login_required
 def add_regular_expense():
@@ -1456,6 +2557,7 @@ def add_regular_expense():
         result = mongo.db.regular_expenses.insert_one(expense)
 
         if result.inserted_id:
+            inc_finance_rollup(user_id, date, regular_expense_rollup_inc(expense))
             flash('支出添加成功！', 'success')
         else:
             flash('添加支出时出错', 'error')
@@ -1473,13 +2575,14 @@ def delete_expense(expense_id):
     try:
         user_id = ObjectId(session['user_id'])
 
-        # 删除支出
-        result = mongo.db.regular_expenses.delete_one({
+        # 删除支出，同时取回被删除的文档用于扣减汇总
+        expense = mongo.db.regular_expenses.find_one_and_delete({
             '_id': ObjectId(expense_id),
             'user_id': user_id
         })
 
-        if result.deleted_count > 0:
+        if expense:
+            inc_finance_rollup(user_id, expense['date'], regular_expense_rollup_inc(expense, sign=-1))
             return jsonify({'success': True})
         return jsonify({'success': False, 'message': '未找到支出'})
 
@@ -1594,6 +2697,7 @@ def add_fixed_expense():
         result = mongo.db.fixed_expenses.insert_one(expense)
 
         if result.inserted_id:
+            inc_fixed_expense_totals(user_id, fixed_expense_totals_inc(expense))
             flash('固定支出添加成功！', 'success')
         else:
             flash('添加固定支出时出错', 'error')
@@ -1611,13 +2715,14 @@ def delete_fixed_expense(expense_id):
     try:
         user_id = ObjectId(session['user_id'])
 
-        # 删除支出
-        result = mongo.db.fixed_expenses.delete_one({
+        # 删除支出，同时取回被删除的文档用于扣减汇总
+        expense = mongo.db.fixed_expenses.find_one_and_delete({
             '_id': ObjectId(expense_id),
             'user_id': user_id
         })
 
-        if result.deleted_count > 0:
+        if expense:
+            inc_fixed_expense_totals(user_id, fixed_expense_totals_inc(expense, sign=-1))
             return jsonify({'success': True})
         return jsonify({'success': False, 'message': '未找到支出'})
 
@@ -1632,13 +2737,14 @@ def update_payment_status(expense_id):
     try:
         user_id = ObjectId(session['user_id'])
         data = request.get_json()
-        is_paid = data.get('is_paid', False)
+        is_paid = bool(data.get('is_paid', False))
 
-        # 更新支付状态
-        result = mongo.db.fixed_expenses.update_one(
+        # 只匹配状态确实发生变化的支出，返回更新前的文档用于调整已付/待付汇总
+        expense = mongo.db.fixed_expenses.find_one_and_update(
             {
                 '_id': ObjectId(expense_id),
-                'user_id': user_id
+                'user_id': user_id,
+                'is_paid': {'$ne': True} if is_paid else True
             },
             {
                 '$set': {
@@ -1648,7 +2754,9 @@ def update_payment_status(expense_id):
             }
         )
 
-        if result.modified_count > 0:
+        if expense:
+            sign = 1 if is_paid else -1
+            inc_fixed_expense_totals(user_id, {'paid_total': sign * expense['amount']})
             return jsonify({'success': True})
         return jsonify({'success': False, 'message': '未找到支出'})
 
@@ -1657,6 +2765,137 @@ def update_payment_status(expense_id):
         return jsonify({'success': False, 'message': str(e)})
 
 
+WEEKDAY_NAMES = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday')
+DOSE_ID_FORMAT = '%Y%m%d%H%M'
+
+
+def medicine_start_date(medicine):
+    """服药规则的生效日期；旧数据没有 start_date，使用创建日期"""
+    start = medicine.get('start_date') or medicine.get('created_at')
+    return start.date() if start else datetime.min.date()
+
+
+def dose_id(medicine_id, scheduled_at):
+    """单次服药的标识：药品 ID + 计划时间，例如 65f0...c1-202501010800"""
+    return f"{medicine_id}-{scheduled_at.strftime(DOSE_ID_FORMAT)}"
+
+
+def parse_dose_id(value):
+    medicine_id, _, scheduled_at = value.partition('-')
+    return ObjectId(medicine_id), datetime.strptime(scheduled_at, DOSE_ID_FORMAT)
+
+
+def is_scheduled_dose(medicine, scheduled_at):
+    """scheduled_at 是否是该药品规则中的一次服药"""
+    return (scheduled_at.date() >= medicine_start_date(medicine)
+            and WEEKDAY_NAMES[scheduled_at.weekday()] in medicine.get('days', [])
+            and scheduled_at.strftime('%H:%M') in medicine.get('times', []))
+
+
+def expand_medicine_doses(medicines, start, end):
+    """按药品上的规则（星期 × 时间）展开 [start, end) 内的每一次服药，按时间排序"""
+    doses = []
+    for medicine in medicines:
+        times = []
+        for time_str in medicine.get('times', []):
+            try:
+                times.append((time_str, datetime.strptime(time_str, '%H:%M').time()))
+            except ValueError:
+                continue
+        day = max(start.date(), medicine_start_date(medicine))
+        while day <= end.date():
+            if WEEKDAY_NAMES[day.weekday()] in medicine.get('days', []):
+                for time_str, time_obj in times:
+                    scheduled_at = datetime.combine(day, time_obj)
+                    if start <= scheduled_at < end:
+                        doses.append({
+                            '_id': dose_id(medicine['_id'], scheduled_at),
+                            'user_id': medicine['user_id'],
+                            'medicine_id': medicine['_id'],
+                            'medicine_name': medicine.get('name'),
+                            'dosage': medicine.get('dosage'),
+                            'frequency': medicine.get('frequency'),
+                            'times': medicine.get('times', []),
+                            'days': medicine.get('days', []),
+                            'notes': medicine.get('notes'),
+                            'time': time_str,
+                            'date': scheduled_at,
+                            'status': 'pending',
+                            'is_taken': False,
+                            'taken_at': None,
+                        })
+            day += timedelta(days=1)
+    doses.sort(key=lambda dose: (dose['date'], dose['medicine_name'] or ''))
+    return doses
+
+
+def dose_status(record):
+    """服药记录的状态；旧版本预生成的条目只有 is_taken 字段"""
+    return record.get('status') or ('taken' if record.get('is_taken') else 'pending')
+
+
+def get_medicine_doses(user_id, start, end, medicines=None):
+    """某用户 [start, end) 内的服药计划：规则展开后叠加服用/跳过记录（一次查询）"""
+    if medicines is None:
+        medicines = list(mongo.db.medicines.find({'user_id': user_id}))
+    records = {
+        (record['medicine_id'], record['date']): record
+        for record in mongo.db.medicine_schedule.find(
+            {'user_id': user_id, 'date': {'$gte': start, '$lt': end}},
+            {'medicine_id': 1, 'date': 1, 'status': 1, 'is_taken': 1, 'taken_at': 1}
+        )
+    }
+    doses = expand_medicine_doses(medicines, start, end)
+    for dose in doses:
+        record = records.get((dose['medicine_id'], dose['date']))
+        if record:
+            dose['status'] = dose_status(record)
+            dose['is_taken'] = dose['status'] == 'taken'
+            dose['taken_at'] = record.get('taken_at')
+    return doses
+
+
+MEDICINE_MAINTENANCE_CHUNK_SIZE = 1000
+
+
+def dedupe_medicine_schedule_records():
+    """删除 (medicine_id, date) 重复的服药记录，每组保留最近更新的一条。
+    在 migrate 中创建唯一索引之前执行，可重复执行"""
+    deleted = 0
+    duplicates = mongo.db.medicine_schedule.aggregate([
+        {'$sort': {'updated_at': -1, '_id': -1}},
+        {'$group': {'_id': {'medicine_id': '$medicine_id', 'date': '$date'},
+                    'ids': {'$push': '$_id'}, 'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}},
+    ], allowDiskUse=True)
+    for group in duplicates:
+        deleted += mongo.db.medicine_schedule.delete_many({'_id': {'$in': group['ids'][1:]}}).deleted_count
+    if deleted:
+        print(f"删除了 {deleted} 条重复的服药记录")
+    return deleted
+
+
+@background_job('medicine-schedule-maintenance', lease_seconds=3600, trigger='cron', hour=3)
+def medicine_schedule_maintenance():
+    """夜间维护 medicine_schedule，保持它只包含稀疏的服用记录：
+    分批删除旧版本预生成的未服用条目，以及取消勾选后留下的、已经过去的 pending 记录。
+    服药计划本身由规则展开，不需要任何任务去延长。"""
+    yesterday = datetime.combine(datetime.now().date(), datetime.min.time()) - timedelta(days=1)
+    stale = {'is_taken': False, '$or': [
+        {'status': {'$exists': False}},
+        {'status': 'pending', 'date': {'$lt': yesterday}},
+    ]}
+    deleted = 0
+    while True:
+        ids = [doc['_id'] for doc in
+               mongo.db.medicine_schedule.find(stale, {'_id': 1}).limit(MEDICINE_MAINTENANCE_CHUNK_SIZE)]
+        if not ids:
+            break
+        deleted += mongo.db.medicine_schedule.delete_many({'_id': {'$in': ids}}).deleted_count
+    print(f"删除了 {deleted} 条多余的服药计划记录")
+    return deleted
+
+
 @app.route('/medicine-management')
 @login_required
 def medicine_management():
@@ -1670,32 +2909,12 @@ def medicine_management():
         }).sort('name', 1))
         print(f"在数据库中找到 {len(medicines)} 种药品")
 
-        # 获取今日药品计划
-        today = datetime.now()
-        today_start = datetime.combine(today.date(), datetime.min.time())
-        today_end = datetime.combine(today.date(), datetime.max.time())
-        print(f"查找 {today_start} 到 {today_end} 之间的药品")
-
-        today_medicines = list(mongo.db.medicine_schedule.find({
-            'user_id': user_id,
-            'date': {
-                '$gte': today_start,
-                '$lte': today_end
-            },
-            'is_taken': False
-        }).sort('time', 1))
-        print(f"找到 {len(today_medicines)} 种今日计划的药品")
-
-        # 获取今日已服用的药品
-        taken_medicines = list(mongo.db.medicine_schedule.find({
-            'user_id': user_id,
-            'date': {
-                '$gte': today_start,
-                '$lte': today_end
-            },
-            'is_taken': True
-        }).sort('time', 1))
-        print(f"找到 {len(taken_medicines)} 种今日已服用的药品")
+        # 今日服药计划由规则展开，已服用/跳过的状态来自一次记录查询
+        today_start = datetime.combine(datetime.now().date(), datetime.min.time())
+        doses = get_medicine_doses(user_id, today_start, today_start + timedelta(days=1), medicines)
+        today_medicines = [dose for dose in doses if dose['status'] == 'pending']
+        taken_medicines = [dose for dose in doses if dose['status'] == 'taken']
+        print(f"今日计划 {len(today_medicines)} 次待服用，{len(taken_medicines)} 次已服用")
 
         # 获取此页面的任何待处理通知
         notification = session.pop('medicine_notification', None)
@@ -1737,6 +2956,13 @@ def add_medicine():
             session['medicine_notification'] = {'type': 'error', 'message': '请选择至少一天'}
             return redirect(url_for('medicine_management'))
 
+        try:
+            for time_str in times:
+                datetime.strptime(time_str, '%H:%M')
+        except ValueError:
+            session['medicine_notification'] = {'type': 'error', 'message': '服药时间格式无效'}
+            return redirect(url_for('medicine_management'))
+
         # 创建药品文档
         medicine = {
             'user_id': user_id,
@@ -1746,6 +2972,8 @@ def add_medicine():
             'times': times,
             'days': days,
             'notes': notes,
+            # 服药计划从这一天起按 days × times 规则展开，不再预先生成条目
+            'start_date': datetime.combine(datetime.now().date(), datetime.min.time()),
             'created_at': datetime.utcnow()
         }
 
@@ -1754,35 +2982,6 @@ def add_medicine():
         print(f"插入药品ID: {result.inserted_id}")
 
         if result.inserted_id:
-            # 为未来30天创建计划条目
-            schedule_entries = []
-            start_date = datetime.now().date()
-
-            for i in range(30):
-                current_date = start_date + timedelta(days=i)
-                day_name = current_date.strftime('%A').lower()
-
-                if day_name in days:
-                    for time_str in times:
-                        time_obj = datetime.strptime(time_str, '%H:%M').time()
-                        schedule_datetime = datetime.combine(current_date, time_obj)
-
-                        schedule_entries.append({
-                            'user_id': user_id,
-                            'medicine_id': result.inserted_id,
-                            'medicine_name': name,
-                            'dosage': dosage,
-                            'time': time_str,
-                            'date': schedule_datetime,
-                            'is_taken': False,
-                            'created_at': datetime.utcnow()
-                        })
-
-            if schedule_entries:
-                print(f"创建 {len(schedule_entries)} 个计划条目")
-                schedule_result = mongo.db.medicine_schedule.insert_many(schedule_entries)
-                print(f"插入 {len(schedule_result.inserted_ids)} 个计划条目")
-
             session['medicine_notification'] = {'type': 'success', 'message': '药品添加成功！'}
         else:
             session['medicine_notification'] = {'type': 'error', 'message': '添加药品时出错'}
@@ -1797,28 +2996,46 @@ def add_medicine():
 @app.route('/update-medicine-status/<schedule_id>', methods=['POST'])
 @login_required
 def update_medicine_status(schedule_id):
+    """记录一次服药的状态。schedule_id 是 dose_id() 生成的 "药品ID-计划时间"，
+    只有状态变化时才写入一条稀疏记录"""
     try:
         user_id = ObjectId(session['user_id'])
         data = request.get_json()
-        is_taken = data.get('is_taken', False)
+        status = data.get('status') or ('taken' if data.get('is_taken', False) else 'pending')
+        if status not in ('taken', 'skipped', 'pending'):
+            return jsonify({'success': False, 'message': '无效的状态'})
 
-        # 更新药品状态
-        result = mongo.db.medicine_schedule.update_one(
-            {
-                '_id': ObjectId(schedule_id),
-                'user_id': user_id
+        try:
+            medicine_id, scheduled_at = parse_dose_id(schedule_id)
+        except (InvalidId, ValueError):
+            return jsonify({'success': False, 'message': '未找到药品计划'})
+
+        medicine = mongo.db.medicines.find_one({'_id': medicine_id, 'user_id': user_id})
+        if not medicine or not is_scheduled_dose(medicine, scheduled_at):
+            return jsonify({'success': False, 'message': '未找到药品计划'})
+
+        # 取消勾选时保留一条 pending 记录而不是删除，子女仪表盘依赖 updated_at 轮询状态变化
+        now = datetime.utcnow()
+        record_filter = {'medicine_id': medicine_id, 'date': scheduled_at}
+        record_update = {
+            '$set': {
+                'user_id': user_id,
+                'medicine_name': medicine.get('name'),
+                'dosage': medicine.get('dosage'),
+                'time': scheduled_at.strftime('%H:%M'),
+                'status': status,
+                'is_taken': status == 'taken',
+                'taken_at': now if status == 'taken' else None,
+                'updated_at': now
             },
-            {
-                '$set': {
-                    'is_taken': is_taken,
-                    'taken_at': datetime.utcnow() if is_taken else None
-                }
-            }
-        )
-
-        if result.modified_count > 0:
-            return jsonify({'success': True})
-        return jsonify({'success': False, 'message': '未找到药品计划'})
+            '$setOnInsert': {'created_at': now}
+        }
+        try:
+            mongo.db.medicine_schedule.update_one(record_filter, record_update, upsert=True)
+        except DuplicateKeyError:
+            # 并发的两次勾选同时插入，唯一索引拒绝了后一个；此时记录已存在，重试即为更新
+            mongo.db.medicine_schedule.update_one(record_filter, record_update, upsert=True)
+        return jsonify({'success': True})
 
     except Exception as e:
         print(f"更新药品状态时出错: {str(e)}")
@@ -1849,35 +3066,78 @@ def delete_medicine(medicine_id):
         return jsonify({'success': False, 'message': str(e)})
 
 
+REMINDER_BACKFILL_BATCH_SIZE = 1000
+COMPLETED_REMINDERS_PAGE_SIZE = 20
+# 完成超过这么多天的提醒由 reminders-archive 任务移入 reminders_archive
+REMINDER_ARCHIVE_DAYS = int(os.environ.get("REMINDER_ARCHIVE_DAYS", 90))
+REMINDER_ARCHIVE_BATCH_SIZE = 1000
+
+
+def reminder_due_at(date, time):
+    """由表单的日期和时间字符串得到提醒的到期时间，格式不正确时返回 None"""
+    try:
+        return datetime.strptime(f"{date} {time}", '%Y-%m-%d %H:%M')
+    except (TypeError, ValueError):
+        return None
+
+
+def backfill_reminder_due_at():
+    """为旧提醒补写 due_at，每批 REMINDER_BACKFILL_BATCH_SIZE 条，可重复执行。
+    无法解析的日期时间写入 None，避免下次重复扫描"""
+    updated = 0
+    while True:
+        batch = list(mongo.db.reminders.find({'due_at': {'$exists': False}}, {'date': 1, 'time': 1})
+                     .limit(REMINDER_BACKFILL_BATCH_SIZE))
+        if not batch:
+            break
+        mongo.db.reminders.bulk_write([
+            UpdateOne({'_id': reminder['_id']},
+                      {'$set': {'due_at': reminder_due_at(reminder.get('date'), reminder.get('time'))}})
+            for reminder in batch
+        ], ordered=False)
+        updated += len(batch)
+    if updated:
+        print(f"为 {updated} 条提醒补写了 due_at")
+    return updated
+
+
 @app.route('/reminders')
 @login_required
 def reminders():
     try:
         user_id = ObjectId(session['user_id'])
-        now = datetime.now()
-        today = now.date()
-        tomorrow = today + timedelta(days=1)
-        day_after = today + timedelta(days=2)
-
-        # 未来2天的提醒
-        next_two_days = list(mongo.db.reminders.find({
-            'user_id': user_id,
-            'completed': False,
-            'date': {'$gte': today.strftime('%Y-%m-%d'), '$lte': day_after.strftime('%Y-%m-%d')}
-        }).sort([('date', 1), ('time', 1)]))
+        today_start = datetime.combine(datetime.now().date(), datetime.min.time())
+        upcoming_start = today_start + timedelta(days=3)
 
-        # 即将到来的提醒（未来2天之后）
-        upcoming = list(mongo.db.reminders.find({
+        # 未完成的提醒：一次按 due_at 排序的范围查询，再按时间切分为未来2天（今天起3个自然日）和之后
+        pending = list(mongo.db.reminders.find({
             'user_id': user_id,
             'completed': False,
-            'date': {'$gt': day_after.strftime('%Y-%m-%d')}
-        }).sort([('date', 1), ('time', 1)]))
-
-        # 已完成的提醒
-        completed = list(mongo.db.reminders.find({
-            'user_id': user_id,
-            'completed': True
-        }).sort([('completed_at', -1)]))
+            'due_at': {'$gte': today_start}
+        }).sort('due_at', 1))
+        next_two_days = [r for r in pending if r['due_at'] < upcoming_start]
+        upcoming = [r for r in pending if r['due_at'] >= upcoming_start]
+
+        # 已完成的提醒：按 (completed_at, _id) 倒序做 keyset 分页
+        completed_query = {'user_id': user_id, 'completed': True}
+        completed_after = request.args.get('completed_after')
+        if completed_after:
+            try:
+                after_completed_at, after_id = decode_keyset_cursor(completed_after)
+                completed_query['$or'] = [
+                    {'completed_at': {'$lt': after_completed_at}},
+                    {'completed_at': after_completed_at, '_id': {'$lt': after_id}}
+                ]
+            except (ValueError, TypeError):
+                completed_after = None
+
+        completed = list(mongo.db.reminders.find(completed_query)
+                         .sort([('completed_at', -1), ('_id', -1)])
+                         .limit(COMPLETED_REMINDERS_PAGE_SIZE + 1))
+        completed_next_cursor = None
+        if len(completed) > COMPLETED_REMINDERS_PAGE_SIZE:
+            completed = completed[:COMPLETED_REMINDERS_PAGE_SIZE]
+            completed_next_cursor = encode_keyset_cursor([completed[-1].get('completed_at'), completed[-1]['_id']])
 
         # 获取此页面的任何待处理通知
         notification = session.pop('reminder_notification', None)
@@ -1886,6 +3146,8 @@ def reminders():
                                next_two_days=next_two_days,
                                upcoming=upcoming,
                                completed=completed,
+                               completed_next_cursor=completed_next_cursor,
+                               is_first_completed_page=not completed_after,
                                notification=notification)
     except Exception as e:
         print(f"提醒路由错误: {str(e)}")
@@ -1893,6 +3155,27 @@ def reminders():
         return redirect(url_for('dashboard'))
 
 
+@background_job('reminders-archive', lease_seconds=3600, trigger='cron', hour=3, minute=30)
+def archive_completed_reminders():
+    """分批把完成超过 REMINDER_ARCHIVE_DAYS 天的提醒移入 reminders_archive，保持 reminders 集合和索引精简。
+    先按 _id upsert 到归档集合再删除，中途失败重跑不会丢失或重复"""
+    cutoff = datetime.utcnow() - timedelta(days=REMINDER_ARCHIVE_DAYS)
+    archived = 0
+    while True:
+        batch = list(mongo.db.reminders.find({'completed': True, 'completed_at': {'$lt': cutoff}})
+                     .limit(REMINDER_ARCHIVE_BATCH_SIZE))
+        if not batch:
+            break
+        mongo.db.reminders_archive.bulk_write(
+            [ReplaceOne({'_id': reminder['_id']}, reminder, upsert=True) for reminder in batch],
+            ordered=False
+        )
+        mongo.db.reminders.delete_many({'_id': {'$in': [reminder['_id'] for reminder in batch]}})
+        archived += len(batch)
+    print(f"归档了 {archived} 条已完成的提醒")
+    return archived
+
+
 @app.route('/add-reminder', methods=['POST'])
 @login_required
 def add_reminder():
@@ -1907,14 +3190,22 @@ def add_reminder():
             session['reminder_notification'] = {'type': 'error', 'message': '标题、日期和时间是必填项！'}
             return redirect(url_for('reminders'))
 
+        due_at = reminder_due_at(date, time)
+        if not due_at:
+            session['reminder_notification'] = {'type': 'error', 'message': '日期或时间格式无效'}
+            return redirect(url_for('reminders'))
+
+        # date/time 字符串仅用于展示，查询和排序都使用 due_at
         reminder = {
             'user_id': user_id,
             'title': title,
             'description': description,
             'date': date,
             'time': time,
+            'due_at': due_at,
             'completed': False,
-            'created_at': datetime.utcnow()
+            'created_at': datetime.utcnow(),
+            'updated_at': datetime.utcnow()
         }
 
         result = mongo.db.reminders.insert_one(reminder)
@@ -1936,7 +3227,7 @@ def complete_reminder(reminder_id):
     user_id = ObjectId(session['user_id'])
     result = mongo.db.reminders.update_one(
         {'_id': ObjectId(reminder_id), 'user_id': user_id},
-        {'$set': {'completed': True, 'completed_at': datetime.utcnow()}}
+        {'$set': {'completed': True, 'completed_at': datetime.utcnow(), 'updated_at': datetime.utcnow()}}
     )
     if result.modified_count > 0:
         return jsonify({'success': True})
@@ -1961,6 +3252,266 @@ def delete_reminder(reminder_id):
         return jsonify({'success': False, 'message': str(e)})
 
 
+# 到期分发器：每隔 DUE_DISPATCH_REFILL_SECONDS 把之后 DUE_DISPATCH_LOOKAHEAD_SECONDS 内到期的
+# 服药和提醒批量加载进内存中的最小堆，由一个线程在到期的那一分钟调用通知钩子。
+# 数据库只在补充窗口和真正有条目到期时访问，不按分钟轮询。
+DUE_DISPATCH_REFILL_SECONDS = int(os.environ.get("DUE_DISPATCH_REFILL_SECONDS", 300))
+DUE_DISPATCH_LOOKAHEAD_SECONDS = 2 * DUE_DISPATCH_REFILL_SECONDS
+# 分发器延迟（例如刚接任 leader）时，超过这个时长的到期条目不再通知
+DUE_DISPATCH_GRACE_SECONDS = 600
+# 已发送通知的记录（due_notifications，_id 为条目 key）保留时长，用于 leader 交接时去重
+DUE_NOTIFICATION_RECORD_TTL_SECONDS = 24 * 3600
+MEDICINE_RULE_PROJECTION = {'user_id': 1, 'name': 1, 'dosage': 1, 'times': 1, 'days': 1,
+                            'start_date': 1, 'created_at': 1}
+
+
+class DueDispatcher:
+    """到期提醒分发器。只在持有 due-dispatcher 租约的进程中加载数据，
+    窗口按 [上次加载到的时间, now + lookahead) 增量补充，新增的药品和提醒通过 created_at/updated_at 补进来"""
+
+    def __init__(self):
+        self.hooks = []
+        self._heap = []
+        self._scheduled = {}
+        self._medicines = {}
+        self._loaded_until = None
+        self._last_refill = None
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def reset(self):
+        """失去租约时清空窗口，交给新的 leader 处理"""
+        with self._cond:
+            self._heap = []
+            self._scheduled = {}
+            self._medicines = {}
+            self._loaded_until = None
+            self._last_refill = None
+
+    def refill(self):
+        now = datetime.now()
+        refill_started = datetime.utcnow()
+        horizon = now + timedelta(seconds=DUE_DISPATCH_LOOKAHEAD_SECONDS)
+
+        if self._loaded_until is None:
+            # 刚成为 leader：全量加载药品规则，之后只增量加载新药品。
+            # 从 now - grace 开始加载，补上前一个 leader 最后一次补充之后、退出之前到期的条目；
+            # 它已经通知过的条目由 fire() 中的 due_notifications 去重
+            medicines = list(mongo.db.medicines.find({}, MEDICINE_RULE_PROJECTION))
+            new_medicines = []
+            start = now - timedelta(seconds=DUE_DISPATCH_GRACE_SECONDS)
+        else:
+            medicines = []
+            new_medicines = list(mongo.db.medicines.find({'created_at': {'$gt': self._last_refill}},
+                                                         MEDICINE_RULE_PROJECTION))
+            start = self._loaded_until
+        with self._cond:
+            self._medicines.update((m['_id'], m) for m in medicines + new_medicines)
+            medicines = list(self._medicines.values())
+
+        items = []
+        for dose in (expand_medicine_doses(medicines, start, horizon)
+                     + expand_medicine_doses(new_medicines, now, horizon)):
+            items.append({
+                'kind': 'medicine',
+                'key': dose['_id'],
+                'user_id': dose['user_id'],
+                'medicine_id': dose['medicine_id'],
+                'due_at': dose['date'],
+                'title': dose['medicine_name'],
+                'detail': dose['dosage'],
+            })
+
+        # 提醒：新窗口内的，加上上次补充之后新建/修改、落在当前窗口内的
+        reminder_query = {'completed': False, 'due_at': {'$gte': start, '$lt': horizon}}
+        if self._last_refill is not None:
+            reminder_query = {'$or': [reminder_query, {'completed': False, 'updated_at': {'$gt': self._last_refill}}]}
+        for reminder in mongo.db.reminders.find(reminder_query, {'user_id': 1, 'title': 1, 'description': 1,
+                                                                 'due_at': 1}):
+            due_at = reminder.get('due_at')
+            if due_at and now - timedelta(seconds=DUE_DISPATCH_GRACE_SECONDS) <= due_at < horizon:
+                items.append({
+                    'kind': 'reminder',
+                    'key': f"reminder-{reminder['_id']}",
+                    'user_id': reminder['user_id'],
+                    'reminder_id': reminder['_id'],
+                    'due_at': due_at,
+                    'title': reminder.get('title'),
+                    'detail': reminder.get('description'),
+                })
+
+        with self._cond:
+            stale = now - timedelta(seconds=DUE_DISPATCH_GRACE_SECONDS)
+            self._scheduled = {key: due_at for key, due_at in self._scheduled.items() if due_at >= stale}
+            added = 0
+            for item in items:
+                if item['key'] in self._scheduled:
+                    continue
+                self._scheduled[item['key']] = item['due_at']
+                heapq.heappush(self._heap, (item['due_at'], item['key'], item))
+                added += 1
+            self._loaded_until = horizon
+            self._last_refill = refill_started
+            self._cond.notify()
+
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='due-dispatcher', daemon=True)
+            self._thread.start()
+        return added
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > datetime.now():
+                    timeout = (self._heap[0][0] - datetime.now()).total_seconds() if self._heap else None
+                    self._cond.wait(timeout)
+                now = datetime.now()
+                due = []
+                while self._heap and self._heap[0][0] <= now:
+                    due.append(heapq.heappop(self._heap)[2])
+            try:
+                self.fire(due, now)
+            except Exception as e:
+                print(f"到期提醒分发出错: {str(e)}")
+
+    def fire(self, items, now):
+        """通知一批到期条目：先用一次查询排除已服用/跳过的服药、已删除的药品和已完成的提醒"""
+        items = [item for item in items
+                 if (now - item['due_at']).total_seconds() <= DUE_DISPATCH_GRACE_SECONDS]
+        doses = [item for item in items if item['kind'] == 'medicine']
+        reminders = [item for item in items if item['kind'] == 'reminder']
+
+        if doses:
+            medicine_ids = list({item['medicine_id'] for item in doses})
+            existing = {m['_id'] for m in mongo.db.medicines.find({'_id': {'$in': medicine_ids}}, {'_id': 1})}
+            recorded = {
+                (record['medicine_id'], record['date'])
+                for record in mongo.db.medicine_schedule.find(
+                    {'medicine_id': {'$in': medicine_ids},
+                     'date': {'$in': list({item['due_at'] for item in doses})},
+                     '$or': [{'is_taken': True}, {'status': 'skipped'}]},
+                    {'medicine_id': 1, 'date': 1}
+                )
+            }
+            with self._cond:
+                for medicine_id in set(medicine_ids) - existing:
+                    self._medicines.pop(medicine_id, None)
+            doses = [item for item in doses
+                     if item['medicine_id'] in existing and (item['medicine_id'], item['due_at']) not in recorded]
+        if reminders:
+            open_ids = {r['_id'] for r in mongo.db.reminders.find(
+                {'_id': {'$in': [item['reminder_id'] for item in reminders]}, 'completed': False}, {'_id': 1})}
+            reminders = [item for item in reminders if item['reminder_id'] in open_ids]
+
+        items = claim_due_notifications(doses + reminders)
+        if not items:
+            return
+        users = {u['_id']: u for u in mongo.db.users.find(
+            {'_id': {'$in': list({item['user_id'] for item in items})}}, {'name': 1, 'email': 1, 'phone': 1})}
+        for item in items:
+            for hook in self.hooks:
+                try:
+                    hook(item, users.get(item['user_id']))
+                except Exception as e:
+                    print(f"通知钩子 {getattr(hook, '__name__', type(hook).__name__)} 出错: {str(e)}")
+
+
+def claim_due_notifications(items):
+    """在 due_notifications 中按条目 key 登记，返回本进程抢到的条目。
+    已经登记过的（例如前一个 leader 已发送）跳过，保证 leader 交接时同一条目只通知一次"""
+    if not items:
+        return []
+    now = datetime.utcnow()
+    try:
+        mongo.db.due_notifications.insert_many([{'_id': item['key'], 'created_at': now} for item in items],
+                                               ordered=False)
+    except BulkWriteError as e:
+        duplicates = {error['index'] for error in e.details['writeErrors'] if error['code'] == 11000}
+        if len(duplicates) < len(e.details['writeErrors']):
+            raise
+        return [item for index, item in enumerate(items) if index not in duplicates]
+    return items
+
+
+def notification_text(item):
+    if item['kind'] == 'medicine':
+        return f"服药提醒：请在 {item['due_at'].strftime('%H:%M')} 服用 {item['title']}（{item['detail'] or ''}）"
+    return f"提醒：{item['title']}（{item['due_at'].strftime('%Y-%m-%d %H:%M')}）"
+
+
+def log_notification_hook(item, user):
+    print(f"[到期提醒] 用户 {item['user_id']}: {notification_text(item)}")
+
+
+class MailNotificationHook:
+    """通过 Flask-Mail 发送邮件，SMTP 参数来自 MAIL_SERVER、MAIL_PORT、MAIL_USERNAME 等环境变量"""
+
+    def __init__(self):
+        from flask_mail import Mail
+
+        app.config["MAIL_SERVER"] = os.environ.get("MAIL_SERVER", "localhost")
+        app.config["MAIL_PORT"] = int(os.environ.get("MAIL_PORT", 25))
+        app.config["MAIL_USE_TLS"] = os.environ.get("MAIL_USE_TLS", "").lower() in ("1", "true", "yes")
+        app.config["MAIL_USERNAME"] = os.environ.get("MAIL_USERNAME")
+        app.config["MAIL_PASSWORD"] = os.environ.get("MAIL_PASSWORD")
+        app.config["MAIL_DEFAULT_SENDER"] = os.environ.get("MAIL_DEFAULT_SENDER")
+        self.mail = Mail(app)
+
+    def __call__(self, item, user):
+        from flask_mail import Message
+
+        if not user or not user.get('email'):
+            return
+        with app.app_context():
+            self.mail.send(Message(subject='JNU智慧康养平台提醒', recipients=[user['email']],
+                                   body=notification_text(item)))
+
+
+class TwilioSmsHook:
+    """通过 Twilio 发送短信，需要 TWILIO_ACCOUNT_SID、TWILIO_AUTH_TOKEN、TWILIO_FROM_NUMBER"""
+
+    def __init__(self):
+        from twilio.rest import Client
+
+        self.client = Client(os.environ["TWILIO_ACCOUNT_SID"], os.environ["TWILIO_AUTH_TOKEN"])
+        self.from_number = os.environ["TWILIO_FROM_NUMBER"]
+
+    def __call__(self, item, user):
+        if not user or not user.get('phone'):
+            return
+        self.client.messages.create(to=user['phone'], from_=self.from_number, body=notification_text(item))
+
+
+NOTIFICATION_HOOKS = {
+    'log': lambda: log_notification_hook,
+    'mail': MailNotificationHook,
+    'sms': TwilioSmsHook,
+}
+
+
+def build_notification_hooks(names):
+    hooks = []
+    for name in filter(None, (n.strip() for n in names.split(','))):
+        if name not in NOTIFICATION_HOOKS:
+            raise ValueError(f"未知的通知方式: {name}")
+        hooks.append(NOTIFICATION_HOOKS[name]())
+    return hooks
+
+
+due_dispatcher = DueDispatcher()
+
+
+@background_job('due-dispatcher', lease_seconds=None, run_at_start=True,
+                trigger='interval', seconds=DUE_DISPATCH_REFILL_SECONDS)
+def refill_due_dispatcher():
+    """补充到期分发器的窗口。租约比补充间隔长，leader 每次续约；leader 退出后由其他 worker 接任"""
+    if not acquire_job_lease('due-dispatcher', 2 * DUE_DISPATCH_REFILL_SECONDS):
+        due_dispatcher.reset()
+        return
+    added = due_dispatcher.refill()
+    print(f"到期分发器加载了 {added} 个条目")
+
+
 @app.route('/create-emergency-log', methods=['POST'])
 @login_required
 def create_emergency_log():
@@ -1969,7 +3520,7 @@ def create_emergency_log():
         if not data or 'contact_type' not in data or 'phone_number' not in data:
             return jsonify({'success': False, 'message': '缺少必填字段'}), 400
 
-        user = mongo.db.users.find_one({'_id': ObjectId(session['user_id'])})
+        user = get_current_user()
         if not user:
             return jsonify({'success': False, 'message': '未找到用户'}), 404
 
@@ -1993,6 +3544,21 @@ def create_emergency_log():
                 log['linked_child_name'] = linked_child['name']
 
         result = mongo.db.emergency_logs.insert_one(log)
+        if result.inserted_id and app.config["EMERGENCY_LOG_ARCHIVE"]:
+            # 归档副本不受 TTL 影响，_id 相同便于对照
+            mongo.db.emergency_logs_archive.insert_one(log)
+        if result.inserted_id and user['role'] == 'elder':
+            # 实时推送给所有关联子女，推送失败不影响日志本身
+            try:
+                event_broker.publish(elder_channel(user['_id']), 'emergency', to_json_safe({
+                    '_id': log['_id'],
+                    'user_name': log['user_name'],
+                    'contact_type': log['contact_type'],
+                    'phone_number': log['phone_number'],
+                    'created_at': log['created_at']
+                }))
+            except Exception as e:
+                print(f"推送紧急事件时出错: {str(e)}")
         if result.inserted_id:
             return jsonify({'success': True})
         else:
@@ -2008,6 +3574,464 @@ def assistant_chat():
     return render_template('ai_assistant.html')
 
 # ---- AI Assistant API ----
+ASSISTANT_SYSTEM_PROMPT = (
+    "你是 JNU 智慧康养平台的 AI 健康助手，主要为中老年人提供帮助。\n"
+    "你的任务：\n"
+    "1. 提供温和、易懂、通俗易理解的解释。\n"
+    "2. 可以提供健康建议，但禁止医学诊断或药物剂量建议。\n"
+    "3. 如需具体诊疗，一律建议咨询专业医生。\n"
+    "4. 回答尽量短、重点明确、适合老年用户阅读。\n"
+)
+ASSISTANT_TEMPERATURE = 0.3
+ASSISTANT_MAX_TOKENS = 1024
+
+
+class QwenClient:
+    """进程内共享的千问客户端：复用 keep-alive 连接池，避免每次对话都重新做 TCP + TLS 握手。
+    429/5xx 和连接错误按指数退避加随机抖动重试，并遵循 Retry-After"""
+
+    def __init__(self):
+        self.api_key = None
+        self.url = None
+        self.model = None
+        self.timeout = None
+        self.max_retries = 0
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def configure(self, config):
+        self.api_key = config["QWEN_API_KEY"]
+        self.url = config["QWEN_API_BASE"].rstrip("/") + "/chat/completions"
+        self.model = config["QWEN_MODEL"]
+        self.timeout = (config["QWEN_CONNECT_TIMEOUT"], config["QWEN_READ_TIMEOUT"])
+        self.max_retries = config["QWEN_MAX_RETRIES"]
+
+    @property
+    def session(self):
+        # 连接不能跨 fork 共享：gunicorn preload 时在 master 中创建的会话不带进 worker
+        if self._session is None or self._pid != os.getpid():
+            with self._lock:
+                if self._session is None or self._pid != os.getpid():
+                    retry = Retry(
+                        total=self.max_retries,
+                        connect=self.max_retries,
+                        read=0,
+                        status=self.max_retries,
+                        status_forcelist=(429, 500, 502, 503, 504),
+                        allowed_methods=frozenset(['POST']),
+                        backoff_factor=0.5,
+                        backoff_jitter=0.5,
+                        respect_retry_after_header=True,
+                        raise_on_status=False,
+                    )
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=32, max_retries=retry)
+                    session = requests.Session()
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    session.headers.update({
+                        "Content-Type": "application/json",
+                        "Authorization": f"Bearer {self.api_key}",
+                    })
+                    self._session = session
+                    self._pid = os.getpid()
+        return self._session
+
+    def chat(self, messages, temperature=ASSISTANT_TEMPERATURE, max_tokens=ASSISTANT_MAX_TOKENS):
+        """调用 chat/completions，返回回复文本。超时和连接错误以 requests 异常抛出"""
+        response = self.session.post(self.url, json={
+            "model": self.model,
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+        }, timeout=self.timeout)
+        response.raise_for_status()
+        result = response.json()
+        return result.get("choices", [{}])[0].get("message", {}).get("content", "")
+
+    def stream_chat(self, messages, temperature=ASSISTANT_TEMPERATURE, max_tokens=ASSISTANT_MAX_TOKENS):
+        """以 stream: true 调用 chat/completions，逐段产出回复文本"""
+        with self.session.post(self.url, json={
+            "model": self.model,
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "stream": True,
+        }, timeout=self.timeout, stream=True) as response:
+            response.raise_for_status()
+            # text/event-stream 没有声明 charset 时 requests 默认按 ISO-8859-1 解码
+            response.encoding = "utf-8"
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                chunk = line[len("data:"):].strip()
+                if chunk == "[DONE]":
+                    break
+                delta = json.loads(chunk).get("choices", [{}])[0].get("delta", {}).get("content")
+                if delta:
+                    yield delta
+
+
+qwen_client = QwenClient()
+
+
+# AI 回复缓存：老年用户反复问的常见问题直接返回缓存的回复。
+# 第一层是每个 worker 的 LRU + TTL 内存缓存；ASSISTANT_CACHE_MONGO=1 时增加 assistant_cache 集合作为
+# 跨 worker、跨重启的第二层（created_at 上的 TTL 索引由 migrate 创建）。
+ASSISTANT_CACHE_TTL_SECONDS = int(os.environ.get("ASSISTANT_CACHE_TTL_SECONDS", 24 * 3600))
+ASSISTANT_CACHE_MONGO = os.environ.get("ASSISTANT_CACHE_MONGO", "").lower() in ("1", "true", "yes")
+ASSISTANT_CACHE_CHANNEL = 'assistant-cache'
+assistant_cache = TTLCache(maxsize=int(os.environ.get("ASSISTANT_CACHE_MAXSIZE", 512)),
+                           ttl=ASSISTANT_CACHE_TTL_SECONDS)
+assistant_cache_listener = None
+assistant_cache_listener_lock = threading.Lock()
+# 命中率统计在进程内累加，最多每隔这么久合并写入一次 assistant_cache_stats
+ASSISTANT_CACHE_STATS_FLUSH_SECONDS = 30
+
+
+# 中日文字符（含 CJK 标点）；这些字符之间的空格没有意义
+CJK_CHARS = '\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff'
+# 问题末尾可以去掉的句末标点（NFKC 之后全角的 ？！ 已转为半角）
+TRAILING_PROMPT_PUNCTUATION = '?!。 '
+
+
+def normalize_prompt(text):
+    """缓存用的问题归一化：只做不改变语义的变换——全角转半角（NFKC）、忽略大小写、合并空白、
+    去掉中日文字符之间的空格和句末的问号/感叹号/句号。比较和运算符号（<>+-=/%.）必须保留，
+    否则“血糖>7”和“血糖<7”会命中同一条缓存"""
+    text = ' '.join(unicodedata.normalize('NFKC', text).casefold().split())
+    text = re.sub(f'(?<=[{CJK_CHARS}]) (?=[{CJK_CHARS}])', '', text)
+    return text.rstrip(TRAILING_PROMPT_PUNCTUATION)
+
+
+def assistant_cache_key(user_message, model, system_prompt=ASSISTANT_SYSTEM_PROMPT,
+                        temperature=ASSISTANT_TEMPERATURE):
+    """缓存键包含模型、system prompt 和 temperature，任何一个变化都不会命中旧回复"""
+    raw = json.dumps([model, system_prompt, temperature, normalize_prompt(user_message)], ensure_ascii=False)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class BufferedCounters:
+    """进程内计数，定期用一次 $inc 合并到 collection 中 _id 为 doc_id 的文档，所有 worker 共用一份。
+    计数不需要精确：进程退出时最多丢失最后一个间隔内的增量"""
+
+    def __init__(self, collection_name, doc_id, flush_seconds):
+        self.collection_name = collection_name
+        self.doc_id = doc_id
+        self.flush_seconds = flush_seconds
+        self._counts = {}
+        self._flushed_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def incr(self, field):
+        with self._lock:
+            self._counts[field] = self._counts.get(field, 0) + 1
+            if time.monotonic() - self._flushed_at < self.flush_seconds:
+                return
+        self.flush()
+
+    def flush(self):
+        with self._lock:
+            counts, self._counts = self._counts, {}
+            self._flushed_at = time.monotonic()
+        if not counts:
+            return
+        try:
+            mongo.db[self.collection_name].update_one({'_id': self.doc_id}, {'$inc': counts}, upsert=True)
+        except Exception as e:
+            print(f"写入 {self.collection_name} 计数出错: {str(e)}")
+            with self._lock:
+                for field, count in counts.items():
+                    self._counts[field] = self._counts.get(field, 0) + count
+
+    def reset(self):
+        with self._lock:
+            self._counts = {}
+
+
+assistant_cache_counters = BufferedCounters('assistant_cache_stats', 'counters', ASSISTANT_CACHE_STATS_FLUSH_SECONDS)
+
+
+def record_assistant_cache_stat(field):
+    assistant_cache_counters.incr(field)
+
+
+def start_assistant_cache_listener():
+    """订阅清空缓存的广播：管理员清空时，每个 worker 都清掉自己的内存缓存和未写入的统计。
+    第一次查缓存时才启动（gunicorn master 中不能在 fork 前创建线程），多个线程同时调用时只启动一次"""
+    global assistant_cache_listener
+    if assistant_cache_listener is not None:
+        return
+
+    def listen(subscriber):
+        while True:
+            subscriber.get()
+            assistant_cache.clear()
+            assistant_cache_counters.reset()
+
+    with assistant_cache_listener_lock:
+        if assistant_cache_listener is not None:
+            return
+        listener = threading.Thread(target=listen, args=(event_broker.subscribe(ASSISTANT_CACHE_CHANNEL),),
+                                    name='assistant-cache-listener', daemon=True)
+        listener.start()
+        assistant_cache_listener = listener
+
+
+def get_cached_reply(key):
+    start_assistant_cache_listener()
+    reply = assistant_cache.get(key)
+    if reply is not None:
+        record_assistant_cache_stat('memory_hits')
+        return reply
+    if ASSISTANT_CACHE_MONGO:
+        doc = mongo.db.assistant_cache.find_one({'_id': key}, {'reply': 1})
+        if doc:
+            assistant_cache.set(key, doc['reply'])
+            record_assistant_cache_stat('mongo_hits')
+            return doc['reply']
+    record_assistant_cache_stat('misses')
+    return None
+
+
+def set_cached_reply(key, reply):
+    assistant_cache.set(key, reply)
+    if ASSISTANT_CACHE_MONGO:
+        try:
+            mongo.db.assistant_cache.replace_one({'_id': key}, {'reply': reply, 'created_at': datetime.utcnow()},
+                                                 upsert=True)
+        except Exception as e:
+            print(f"写入 AI 缓存出错: {str(e)}")
+
+
+def assistant_cache_stats():
+    """汇总所有 worker 已写入的统计；其他 worker 尚未写入的增量最多延迟 ASSISTANT_CACHE_STATS_FLUSH_SECONDS 秒"""
+    assistant_cache_counters.flush()
+    counters = mongo.db.assistant_cache_stats.find_one({'_id': 'counters'}) or {}
+    hits = counters.get('memory_hits', 0) + counters.get('mongo_hits', 0)
+    total = hits + counters.get('misses', 0)
+    return {
+        'memory_hits': counters.get('memory_hits', 0),
+        'mongo_hits': counters.get('mongo_hits', 0),
+        'misses': counters.get('misses', 0),
+        'hit_rate': round(hits * 100 / total, 1) if total else None,
+        'mongo_entries': mongo.db.assistant_cache.estimated_document_count() if ASSISTANT_CACHE_MONGO else None,
+    }
+
+
+@app.route('/admin/api/assistant-cache')
+@login_required
+def admin_assistant_cache():
+    if not session.get('is_admin'):
+        return jsonify({'error': '未授权'}), 403
+    try:
+        return jsonify(assistant_cache_stats())
+    except Exception as e:
+        print(f"读取 AI 缓存统计出错: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/admin/api/assistant-cache/purge', methods=['POST'])
+@login_required
+def admin_purge_assistant_cache():
+    """清空所有 worker 的内存缓存和 Mongo 缓存，并重置命中率统计"""
+    if not session.get('is_admin'):
+        return jsonify({'error': '未授权'}), 403
+    try:
+        assistant_cache.clear()
+        assistant_cache_counters.reset()
+        event_broker.publish(ASSISTANT_CACHE_CHANNEL, 'purge', {})
+        deleted = mongo.db.assistant_cache.delete_many({}).deleted_count
+        mongo.db.assistant_cache_stats.delete_one({'_id': 'counters'})
+        return jsonify({'success': True, 'deleted': deleted})
+    except Exception as e:
+        print(f"清空 AI 缓存出错: {str(e)}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+
+# 所有千问调用都在这个有界线程池中执行：最多 ASSISTANT_MAX_CONCURRENCY 个同时进行，
+# 另外最多 ASSISTANT_MAX_QUEUE 个排队，再多的请求直接返回 429。
+# 请求线程本身只在占到 stream_slots 名额时才等待结果（流式转发或同步等待），
+# 所以无论排队多少，AI 对话占用的请求线程都少于 worker 的线程数，紧急呼叫、仪表盘等路由不受影响。
+ASSISTANT_MAX_CONCURRENCY = int(os.environ.get("ASSISTANT_MAX_CONCURRENCY", 4))
+ASSISTANT_MAX_QUEUE = int(os.environ.get("ASSISTANT_MAX_QUEUE", 16))
+# /assistant/api 最多同步等待这么久，超时后转为异步任务返回 202
+ASSISTANT_SYNC_WAIT_SECONDS = int(os.environ.get("ASSISTANT_SYNC_WAIT_SECONDS", 15))
+# 异步任务结果保留时长，由 assistant_jobs.created_at 上的 TTL 索引删除
+ASSISTANT_JOB_TTL_SECONDS = 3600
+assistant_executor = ThreadPoolExecutor(max_workers=ASSISTANT_MAX_CONCURRENCY, thread_name_prefix='assistant')
+assistant_slots = threading.BoundedSemaphore(ASSISTANT_MAX_CONCURRENCY + ASSISTANT_MAX_QUEUE)
+
+
+def submit_assistant_call(fn, *args):
+    """占用一个名额后提交到 assistant_executor，名额在任务结束（或被取消）时归还；已满时返回 None"""
+    if not assistant_slots.acquire(blocking=False):
+        return None
+    try:
+        future = assistant_executor.submit(fn, *args)
+    except Exception:
+        assistant_slots.release()
+        raise
+    future.add_done_callback(lambda _: assistant_slots.release())
+    return future
+
+
+def assistant_busy_response():
+    return jsonify({"error": "AI 助手正忙，请稍后再试"}), 429
+
+
+# 多轮对话：每个用户一份 assistant_conversations 文档，保存最近的原文轮次和更早轮次的摘要。
+# 发送给模型的历史（摘要 + 最近轮次）不超过 ASSISTANT_CONTEXT_TOKENS，超出的旧轮次在后台压缩进摘要。
+ASSISTANT_CONTEXT_TOKENS = int(os.environ.get("ASSISTANT_CONTEXT_TOKENS", 1500))
+# 超过这么久没有对话则开始新的会话
+ASSISTANT_CONVERSATION_IDLE_SECONDS = int(os.environ.get("ASSISTANT_CONVERSATION_IDLE_SECONDS", 2 * 3600))
+ASSISTANT_SUMMARY_PROMPT = (
+    "请把下面的对话压缩成不超过 200 字的摘要，保留用户的身体状况、关心的问题和已经给出的建议，"
+    "只输出摘要本身。"
+)
+
+
+def estimate_tokens(text):
+    """粗略估算 token 数：中文等宽字符约 1 个 token，其余字符约 4 个一个 token"""
+    wide = sum(1 for ch in text if ord(ch) > 0x2E7F)
+    return wide + (len(text) - wide + 3) // 4
+
+
+def assistant_user_id():
+    """当前会话的用户 ID。管理员会话（'admin'）不在 users 集合中，返回 None：可以对话，但不保存多轮历史"""
+    user_id = session.get('user_id')
+    return ObjectId(user_id) if ObjectId.is_valid(user_id) else None
+
+
+def load_conversation(user_id):
+    """读取用户当前的会话，空闲太久的会话视为已结束"""
+    if user_id is None:
+        return {'_id': None, 'summary': None, 'turns': [], 'is_new': True}
+    conversation = mongo.db.assistant_conversations.find_one({'_id': user_id})
+    idle_since = datetime.utcnow() - timedelta(seconds=ASSISTANT_CONVERSATION_IDLE_SECONDS)
+    if not conversation or conversation.get('updated_at', datetime.min) < idle_since:
+        return {'_id': user_id, 'summary': None, 'turns': [], 'is_new': True}
+    conversation['is_new'] = not conversation.get('summary') and not conversation.get('turns')
+    return conversation
+
+
+def build_assistant_messages(conversation, user_message):
+    """system prompt + 摘要 + 从新到旧放得下的最近轮次 + 本次问题。
+
+    本次问题先计入预算；摘要放不下时截断，预算不会变成负数。
+    """
+    budget = max(ASSISTANT_CONTEXT_TOKENS - estimate_tokens(user_message), 0)
+    messages = [{"role": "system", "content": ASSISTANT_SYSTEM_PROMPT}]
+    summary = conversation.get('summary')
+    if summary and budget:
+        if estimate_tokens(summary) > budget:
+            # 每个字符至少占 1/4 个 token、至多 1 个，按 budget 个字符截断一定放得下
+            summary = summary[:budget]
+        messages.append({"role": "system", "content": f"之前对话的摘要：{summary}"})
+        budget -= estimate_tokens(summary)
+
+    recent = []
+    for turn in reversed(conversation.get('turns', [])):
+        cost = estimate_tokens(turn['content'])
+        if cost > budget:
+            break
+        budget -= cost
+        recent.append({"role": turn['role'], "content": turn['content']})
+    messages.extend(reversed(recent))
+    messages.append({"role": "user", "content": user_message})
+    return messages
+
+
+def record_conversation_turn(conversation, user_message, reply):
+    """追加本轮问答；原文轮次超出预算时提交一次后台摘要"""
+    if conversation['_id'] is None:
+        return
+    try:
+        now = datetime.utcnow()
+        # 每条轮次带唯一 id，摘要完成后按 id 删除
+        turns = [{'id': ObjectId(), 'role': 'user', 'content': user_message, 'at': now},
+                 {'id': ObjectId(), 'role': 'assistant', 'content': reply, 'at': now}]
+        if conversation.get('is_new'):
+            # 空闲过期的旧会话原子地重置；条件带上 updated_at，并发请求中只有第一个会重置，
+            # 其余的（以及还没有文档的新会话）走下面的 $push，不会覆盖别人刚写入的轮次
+            idle_since = now - timedelta(seconds=ASSISTANT_CONVERSATION_IDLE_SECONDS)
+            reset = mongo.db.assistant_conversations.update_one(
+                {'_id': conversation['_id'], 'updated_at': {'$lt': idle_since}},
+                {'$set': {'summary': None, 'turns': turns, 'updated_at': now}}
+            )
+            if reset.matched_count:
+                return
+        update = {
+            '$setOnInsert': {'summary': None},
+            '$push': {'turns': {'$each': turns}},
+            '$set': {'updated_at': now},
+        }
+        try:
+            updated = mongo.db.assistant_conversations.find_one_and_update(
+                {'_id': conversation['_id']}, update, upsert=True, return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:
+            # 两个请求同时插入同一个新会话，输掉的一方重试时文档已经存在
+            updated = mongo.db.assistant_conversations.find_one_and_update(
+                {'_id': conversation['_id']}, update, return_document=ReturnDocument.AFTER)
+
+        # 保留放得下一半预算的最近几对问答，更早的交给摘要；按问答对切分，一问一答不会被拆开
+        kept, budget = 0, ASSISTANT_CONTEXT_TOKENS // 2
+        all_turns = updated.get('turns', [])
+        if sum(estimate_tokens(turn['content']) for turn in all_turns) <= ASSISTANT_CONTEXT_TOKENS:
+            return
+        pairs = [all_turns[i:i + 2] for i in range(0, len(all_turns), 2)]
+        for pair in reversed(pairs):
+            budget -= sum(estimate_tokens(turn['content']) for turn in pair)
+            if budget < 0:
+                break
+            kept += 1
+        old_turns = [turn for pair in pairs[:len(pairs) - kept] for turn in pair]
+        if old_turns:
+            # 线程池已满时跳过，下一轮对话会再尝试
+            submit_assistant_call(summarize_conversation, conversation['_id'], updated.get('summary'), old_turns)
+    except Exception as e:
+        # 记录失败不影响本次回复，只是下一轮少了这段上下文
+        print(f"保存 AI 对话出错: {str(e)}")
+
+
+def summarize_conversation(user_id, summary, turns):
+    """把旧轮次合并进摘要。只有摘要没有被其他请求改动过时才写入，并删除已经摘要的轮次"""
+    transcript = "\n".join(f"{'用户' if turn['role'] == 'user' else '助手'}：{turn['content']}" for turn in turns)
+    if summary:
+        transcript = f"已有摘要：{summary}\n{transcript}"
+    try:
+        new_summary = qwen_client.chat([
+            {"role": "system", "content": ASSISTANT_SUMMARY_PROMPT},
+            {"role": "user", "content": transcript},
+        ], max_tokens=400)
+        if new_summary:
+            # 按 id 删除已摘要的轮次；升级前保存的轮次没有 id，按时间删除（摘要总是在问答对边界切分）
+            summarized = {'$or': [
+                {'id': {'$in': [turn['id'] for turn in turns if 'id' in turn]}},
+                {'id': {'$exists': False}, 'at': {'$lte': turns[-1]['at']}},
+            ]}
+            mongo.db.assistant_conversations.update_one(
+                {'_id': user_id, 'summary': summary},
+                {'$set': {'summary': new_summary}, '$pull': {'turns': summarized}}
+            )
+    except Exception as e:
+        print(f"压缩 AI 对话历史出错: {str(e)}")
+
+
+def generate_assistant_reply(user_id, user_message):
+    """一次完整的非流式对话。只有新会话的第一个问题使用缓存，后续问题依赖上下文"""
+    conversation = load_conversation(user_id)
+    cache_key = assistant_cache_key(user_message, qwen_client.model)
+    reply = get_cached_reply(cache_key) if conversation['is_new'] else None
+    if reply is None:
+        reply = qwen_client.chat(build_assistant_messages(conversation, user_message))
+        if reply and conversation['is_new']:
+            set_cached_reply(cache_key, reply)
+    if reply:
+        record_conversation_turn(conversation, user_message, reply)
+    return reply
+
+
 @app.route('/assistant/api', methods=['POST'])
 @login_required
 def assistant_api():
@@ -2018,47 +4042,23 @@ def assistant_api():
         if not user_message:
             return jsonify({"error": "没有收到有效信息"}), 400
 
-        # 读取环境变量
-        QWEN_API_KEY = os.getenv("QWEN_API_KEY")
-        QWEN_API_BASE = os.getenv("QWEN_API_BASE", "https://dashscope.aliyuncs.com/compatible-mode/v1")
-        QWEN_MODEL = os.getenv("QWEN_MODEL", "qwen3-next-80b-a3b-instruct")
-
-        if not QWEN_API_KEY:
+        if not qwen_client.api_key:
             return jsonify({"error": "服务器未配置 QWEN_API_KEY"}), 500
 
-        # 生成 system prompt —— 增强安全性 + 健康平台定位
-        system_prompt = (
-            "你是 JNU 智慧康养平台的 AI 健康助手，主要为中老年人提供帮助。\n"
-            "你的任务：\n"
-            "1. 提供温和、易懂、通俗易理解的解释。\n"
-            "2. 可以提供健康建议，但禁止医学诊断或药物剂量建议。\n"
-            "3. 如需具体诊疗，一律建议咨询专业医生。\n"
-            "4. 回答尽量短、重点明确、适合老年用户阅读。\n"
-        )
-
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {QWEN_API_KEY}",
-        }
-
-        payload = {
-            "model": QWEN_MODEL,
-            "messages": [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_message},
-            ],
-            "temperature": 0.3,
-            "max_tokens": 1024,
-        }
-
-        url = QWEN_API_BASE.rstrip("/") + "/chat/completions"
-
-        # 发起请求
-        response = requests.post(url, headers=headers, json=payload, timeout=30)
-        response.raise_for_status()
-
-        result = response.json()
-        reply = result.get("choices", [{}])[0].get("message", {}).get("content", "")
+        user_id = assistant_user_id()
+        # 没有空闲的长连接名额时不占用请求线程等待，直接转为异步任务
+        if not stream_slots.acquire():
+            return create_assistant_job(user_id, user_message)
+        try:
+            future = submit_assistant_call(generate_assistant_reply, user_id, user_message)
+            if future is None:
+                return assistant_busy_response()
+            try:
+                reply = future.result(timeout=ASSISTANT_SYNC_WAIT_SECONDS)
+            except FuturesTimeoutError:
+                return adopt_assistant_job(user_id, future)
+        finally:
+            stream_slots.release()
 
         if not reply:
             return jsonify({"error": "AI 无有效回复"}), 500
@@ -2075,6 +4075,214 @@ def assistant_api():
         print(f"AI 助手错误: {str(e)}")
         return jsonify({"error": "AI 服务内部错误", "detail": str(e)}), 500
 
+
+def assistant_job_result(get_reply):
+    """调用 get_reply()，把回复或异常转换成 assistant_jobs 中的状态字段"""
+    try:
+        reply = get_reply()
+        update = {'status': 'done', 'reply': reply} if reply else {'status': 'error', 'error': 'AI 无有效回复'}
+    except requests.exceptions.Timeout:
+        update = {'status': 'error', 'error': 'AI 服务响应超时，请稍后再试'}
+    except requests.exceptions.RequestException as e:
+        print(f"AI 助手任务请求失败: {str(e)}")
+        update = {'status': 'error', 'error': 'AI 服务连接失败'}
+    except Exception as e:
+        print(f"AI 助手任务错误: {str(e)}")
+        update = {'status': 'error', 'error': 'AI 服务内部错误'}
+    update['finished_at'] = datetime.utcnow()
+    return update
+
+
+def run_assistant_job(job_id, user_id, user_message):
+    """在 assistant_executor 中执行异步任务，状态和结果写入 assistant_jobs，任何 worker 都能查询"""
+    mongo.db.assistant_jobs.update_one(
+        {'_id': job_id},
+        {'$set': {'status': 'running'}, '$setOnInsert': {'user_id': user_id, 'created_at': datetime.utcnow()}},
+        upsert=True
+    )
+    update = assistant_job_result(lambda: generate_assistant_reply(user_id, user_message))
+    mongo.db.assistant_jobs.update_one({'_id': job_id}, {'$set': update})
+
+
+def create_assistant_job(user_id, user_message):
+    """提交异步对话任务并返回 202 响应；线程池已满时返回 429"""
+    job_id = ObjectId()
+    if submit_assistant_call(run_assistant_job, job_id, user_id, user_message) is None:
+        return assistant_busy_response()
+    # 任务线程可能已经先写入了 running，这里只在文档不存在时写入 queued
+    mongo.db.assistant_jobs.update_one(
+        {'_id': job_id},
+        {'$setOnInsert': {'user_id': user_id, 'status': 'queued', 'created_at': datetime.utcnow()}},
+        upsert=True
+    )
+    return jsonify({"job_id": str(job_id), "status": "queued"}), 202
+
+
+def adopt_assistant_job(user_id, future):
+    """同步等待超时：把仍在执行的调用登记为异步任务，结束时由回调写入结果，返回 202"""
+    job_id = ObjectId()
+    # 先写入文档再注册回调；调用已经结束时回调会立即执行
+    mongo.db.assistant_jobs.insert_one({'_id': job_id, 'user_id': user_id, 'status': 'running',
+                                        'created_at': datetime.utcnow()})
+
+    def finish(done):
+        try:
+            mongo.db.assistant_jobs.update_one({'_id': job_id}, {'$set': assistant_job_result(done.result)})
+        except Exception as e:
+            print(f"保存 AI 助手任务结果出错: {str(e)}")
+
+    future.add_done_callback(finish)
+    return jsonify({"job_id": str(job_id), "status": "running"}), 202
+
+
+@app.route('/assistant/api/jobs', methods=['POST'])
+@login_required
+def assistant_job_create():
+    """提交异步对话任务，立即返回 job_id，客户端轮询 GET /assistant/api/jobs/<job_id> 获取结果"""
+    try:
+        data = request.get_json(silent=True) or {}
+        user_message = data.get("message", "").strip()
+
+        if not user_message:
+            return jsonify({"error": "没有收到有效信息"}), 400
+
+        if not qwen_client.api_key:
+            return jsonify({"error": "服务器未配置 QWEN_API_KEY"}), 500
+
+        return create_assistant_job(assistant_user_id(), user_message)
+    except Exception as e:
+        print(f"提交 AI 助手任务出错: {str(e)}")
+        return jsonify({"error": "AI 服务内部错误", "detail": str(e)}), 500
+
+
+@app.route('/assistant/api/jobs/<job_id>')
+@login_required
+def assistant_job_status(job_id):
+    try:
+        job = mongo.db.assistant_jobs.find_one({'_id': ObjectId(job_id), 'user_id': assistant_user_id()})
+    except InvalidId:
+        job = None
+    if not job:
+        return jsonify({"error": "任务不存在或已过期"}), 404
+    return jsonify({key: job[key] for key in ('status', 'reply', 'error') if key in job})
+
+
+@app.route('/assistant/api/conversation/reset', methods=['POST'])
+@login_required
+def assistant_conversation_reset():
+    """清空当前用户的对话历史，开始新的会话"""
+    try:
+        user_id = assistant_user_id()
+        if user_id is not None:
+            mongo.db.assistant_conversations.delete_one({'_id': user_id})
+        return jsonify({'success': True})
+    except Exception as e:
+        print(f"清空 AI 对话出错: {str(e)}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+
+@app.route('/assistant/api/stream', methods=['POST'])
+@login_required
+def assistant_api_stream():
+    """流式对话：收到模型的每一段输出就以 SSE 的 token 事件转发，结束时发送 done。
+    请求体与 /assistant/api 相同；不支持流式读取的客户端使用 JSON 接口或异步任务接口。
+    千问调用在 assistant_executor 中执行，请求线程只负责转发"""
+    data = request.get_json(silent=True) or {}
+    user_message = data.get("message", "").strip()
+
+    if not user_message:
+        return jsonify({"error": "没有收到有效信息"}), 400
+
+    if not qwen_client.api_key:
+        return jsonify({"error": "服务器未配置 QWEN_API_KEY"}), 500
+
+    conversation = load_conversation(assistant_user_id())
+    messages = build_assistant_messages(conversation, user_message)
+    cache_key = assistant_cache_key(user_message, qwen_client.model)
+    # 只有新会话的第一个问题使用缓存，后续问题依赖上下文
+    cached = get_cached_reply(cache_key) if conversation['is_new'] else None
+    if cached is not None:
+        record_conversation_turn(conversation, user_message, cached)
+    events = queue.Queue()
+    cancelled = threading.Event()
+
+    def pump():
+        parts = []
+        try:
+            for delta in qwen_client.stream_chat(messages):
+                if cancelled.is_set():
+                    return
+                parts.append(delta)
+                events.put(('token', delta))
+            if parts:
+                # 只缓存、记录完整生成的回复，中途出错或客户端断开的不算
+                reply = ''.join(parts)
+                if conversation['is_new']:
+                    set_cached_reply(cache_key, reply)
+                record_conversation_turn(conversation, user_message, reply)
+            events.put(('end', bool(parts)))
+        except Exception as e:
+            events.put(('error', e))
+
+    future = None
+    if cached is None:
+        # 转发期间占用一个请求线程；名额已满时返回 503，页面退回异步任务接口
+        if not stream_slots.acquire():
+            return jsonify({"error": "流式连接已满，请使用异步任务接口"}), 503
+        future = submit_assistant_call(pump)
+        if future is None:
+            stream_slots.release()
+            return assistant_busy_response()
+
+    def generate():
+        if cached is not None:
+            yield sse_event('token', {'delta': cached})
+            yield sse_event('done', {'cached': True})
+            return
+
+        while True:
+            try:
+                kind, value = events.get(timeout=15)
+            except queue.Empty:
+                # 排队或等待首个 token 时发送心跳
+                yield ': keep-alive\n\n'
+                continue
+            if kind == 'token':
+                yield sse_event('token', {'delta': value})
+            elif kind == 'end':
+                if value:
+                    yield sse_event('done', {})
+                else:
+                    yield sse_event('error', {'error': 'AI 无有效回复'})
+                return
+            elif isinstance(value, requests.exceptions.Timeout):
+                yield sse_event('error', {'error': 'AI 服务响应超时，请稍后再试'})
+                return
+            elif isinstance(value, requests.exceptions.RequestException):
+                print(f"AI 助手流式请求失败: {str(value)}")
+                yield sse_event('error', {'error': 'AI 服务连接失败'})
+                return
+            else:
+                print(f"AI 助手流式输出错误: {str(value)}")
+                yield sse_event('error', {'error': 'AI 服务内部错误'})
+                return
+
+    def on_close():
+        # 客户端断开：还在排队的任务直接取消，已经开始的在下一个 token 处停止
+        cancelled.set()
+        if future is not None:
+            future.cancel()
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(on_close)
+    if future is not None:
+        response.call_on_close(stream_slots.release)
+    return response
+
+
 if __name__ == '__main__':
+    create_app()
+    start_background_jobs()
     port = int(os.environ.get("PORT", 5000))  # 使用服务器分配的端口
     app.run(host="0.0.0.0", port=port, debug=False)  # debug=False 生产环境安全
@@ -0,0 +1,52 @@
+"""简单的吞吐量测试：python bench.py URL [-c 并发数] [-n 请求总数] [--cookie session=...]
+
+用于对比开发服务器（python app.py）与 gunicorn 的 requests/sec，只依赖标准库。
+"""
+import argparse
+import threading
+import time
+import urllib.request
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('url')
+    parser.add_argument('-c', '--concurrency', type=int, default=16)
+    parser.add_argument('-n', '--requests', type=int, default=2000)
+    parser.add_argument('--cookie', help='登录后浏览器中的 session cookie，例如 session=xxx')
+    args = parser.parse_args()
+
+    headers = {'Cookie': args.cookie} if args.cookie else {}
+    remaining = [args.requests]
+    errors = [0]
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            try:
+                req = urllib.request.Request(args.url, headers=headers)
+                with urllib.request.urlopen(req, timeout=30) as resp:
+                    resp.read()
+            except Exception:
+                with lock:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    print(f"{args.url}")
+    print(f"  并发 {args.concurrency}，请求 {args.requests}，失败 {errors[0]}")
+    print(f"  耗时 {elapsed:.2f}s，{args.requests / elapsed:.1f} requests/sec")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+"""gunicorn 配置，所有参数都可以通过环境变量覆盖"""
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+
+# worker 数量：默认 CPU 核数 * 2 + 1
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+
+# worker 类型：
+#   gthread 默认，线程 worker，适合 assistant_api 这类等待外部接口的 I/O 请求和 SSE 长连接
+#   sync    每个 worker 同时处理一个请求，长连接会被 timeout 杀掉，不支持 SSE
+#   gevent  协程 worker，需要额外 pip install gevent，适合大量 SSE 连接
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.environ.get("GUNICORN_THREADS", 8 if worker_class == "gthread" else 1))
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", 1000))
+
+# 告诉应用每个 worker 能同时处理多少请求，SSE 长连接据此给普通请求预留线程（见 RESERVED_REQUEST_THREADS）。
+# gevent 下长连接只占用协程，上限是 worker_connections
+os.environ.setdefault("REQUEST_THREADS", str(worker_connections if worker_class == "gevent" else threads))
+
+# master 进程中加载应用，worker fork 后共享代码页，启动更快
+preload_app = True
+
+# 处理一定数量请求后回收 worker，防止内存缓慢增长；jitter 避免所有 worker 同时重启
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 1000))
+max_requests_jitter = int(os.environ.get("GUNICORN_MAX_REQUESTS_JITTER", 100))
+
+# AI 助手请求最长 30 秒，超时要比它长；收到 TERM/HUP 后给正在处理的请求留出完成时间
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 60))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", 30))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", 5))
+
+accesslog = "-"
+errorlog = "-"
+
+
+def post_fork(server, worker):
+    # 调度器线程不能跨 fork 继承，每个 worker 各自启动；任务通过数据库租约保证只执行一次
+    from app import start_background_jobs
+    start_background_jobs()
@@ -0,0 +1,22 @@
+"""管理员紧急日志历史查询的参数校验：格式错误的参数返回 400，而不是 500。"""
+import pytest
+
+from app import app, create_app
+
+
+@pytest.fixture
+def client(monkeypatch):
+    create_app({'MONGO_URI': 'mongodb://localhost:27017/test', 'SECRET_KEY': 'test', 'TESTING': True})
+    monkeypatch.setitem(app.config, 'EMERGENCY_LOG_ARCHIVE', True)
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = 'admin'
+        sess['is_admin'] = True
+    return client
+
+
+@pytest.mark.parametrize('query', ['user_id=not-an-id', 'start=2025-13-01', 'limit=abc'])
+def test_malformed_parameters_return_400(client, query):
+    response = client.get(f'/admin/emergency_logs/history?{query}')
+    assert response.status_code == 400
+    assert response.get_json() == {'error': '无效的查询参数'}
@@ -0,0 +1,99 @@
+"""管理员面板 keyset 分页：排序字段缺失或为 null 的文档也要出现在后续页中。
+
+用支持本路由所需查询运算符的桩集合代替 mongo.db，排序规则与 MongoDB 一致：null/缺失排在所有值之前。
+"""
+from datetime import datetime, timedelta
+
+import pytest
+from bson import ObjectId
+
+from app import app, create_app, mongo
+
+
+def sort_key(value):
+    return (0, 0) if value is None else (1, value)
+
+
+def matches(document, query):
+    for field, condition in query.items():
+        if field == '$and':
+            if not all(matches(document, sub) for sub in condition):
+                return False
+        elif field == '$or':
+            if not any(matches(document, sub) for sub in condition):
+                return False
+        elif isinstance(condition, dict):
+            value = document.get(field)
+            for op, operand in condition.items():
+                if op == '$ne' and value == operand:
+                    return False
+                # 与 MongoDB 一致：$gt/$lt 只比较同类型的值，不匹配 null
+                if op in ('$gt', '$lt') and (value is None or operand is None):
+                    return False
+                if op == '$gt' and not value > operand:
+                    return False
+                if op == '$lt' and not value < operand:
+                    return False
+        elif document.get(field) != condition:
+            return False
+    return True
+
+
+class StubCursor:
+    def __init__(self, documents):
+        self.documents = documents
+
+    def sort(self, keys):
+        for field, direction in reversed(keys):
+            self.documents.sort(key=lambda doc: sort_key(doc.get(field)), reverse=direction < 0)
+        return self
+
+    def limit(self, count):
+        return self.documents[:count]
+
+
+class StubCollection:
+    def __init__(self, documents):
+        self.documents = documents
+
+    def find(self, query, projection=None):
+        return StubCursor([dict(doc) for doc in self.documents if matches(doc, query)])
+
+
+class StubDatabase:
+    def __init__(self, users):
+        self.collections = {'users': StubCollection(users)}
+
+    def __getitem__(self, name):
+        return self.collections[name]
+
+
+@pytest.fixture
+def client(monkeypatch):
+    create_app({'MONGO_URI': 'mongodb://localhost:27017/test', 'SECRET_KEY': 'test', 'TESTING': True})
+    start = datetime(2025, 1, 1)
+    users = [{'_id': ObjectId(), 'name': f'用户{i}', 'created_at': start + timedelta(days=i % 3)} for i in range(5)]
+    users += [{'_id': ObjectId(), 'name': '无日期'}, {'_id': ObjectId(), 'name': '空日期', 'created_at': None}]
+    monkeypatch.setattr(mongo, 'db', StubDatabase(users))
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = 'admin'
+        sess['is_admin'] = True
+    client.users = users
+    return client
+
+
+@pytest.mark.parametrize('order', ['desc', 'asc'])
+def test_pages_include_documents_without_sort_field(client, order):
+    seen, after = [], None
+    while True:
+        url = f'/admin/api/users?sort=created_at&order={order}&limit=2'
+        response = client.get(url + (f'&after={after}' if after else ''))
+        assert response.status_code == 200
+        data = response.get_json()
+        seen.extend(item['_id'] for item in data['items'])
+        after = data['next_cursor']
+        if not after:
+            break
+    assert sorted(seen) == sorted(str(user['_id']) for user in client.users)
+    assert len(seen) == len(set(seen))
@@ -0,0 +1,154 @@
+"""AI 助手的准入控制：每条路径（429、超时转 202、流式 503、正常流式和客户端断开）结束后，
+stream_slots 和 assistant_slots 的名额都必须全部归还，否则 worker 的请求容量会永久变小。
+
+千问调用和数据库都换成桩，线程池使用真实的 assistant_executor。
+"""
+import threading
+import time
+
+import pytest
+from bson import ObjectId
+
+import app as app_module
+from app import app, create_app, mongo, stream_slots
+
+
+class StubCollection:
+    def __init__(self):
+        self.documents = {}
+
+    def find_one(self, query, projection=None):
+        return self.documents.get(query.get('_id'))
+
+    def insert_one(self, document):
+        self.documents[document['_id']] = dict(document)
+
+    def update_one(self, query, update, upsert=False):
+        document = self.documents.get(query['_id'])
+        if document is None:
+            if not upsert:
+                return
+            document = self.documents[query['_id']] = {'_id': query['_id']}
+            document.update(update.get('$setOnInsert', {}))
+        document.update(update.get('$set', {}))
+
+    def find_one_and_update(self, query, update, **kwargs):
+        self.update_one(query, update, upsert=True)
+        return self.documents[query['_id']]
+
+
+class StubDatabase:
+    def __init__(self):
+        self.collections = {}
+
+    def __getattr__(self, name):
+        return self.collections.setdefault(name, StubCollection())
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, '等待超时'
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def assistant(monkeypatch):
+    create_app({'MONGO_URI': 'mongodb://localhost:27017/test', 'SECRET_KEY': 'test', 'TESTING': True})
+    db = StubDatabase()
+    monkeypatch.setattr(mongo, 'db', db)
+    monkeypatch.setattr(app_module.qwen_client, 'api_key', 'test-key')
+    monkeypatch.setattr(app_module, 'get_cached_reply', lambda key: None)
+    monkeypatch.setattr(app_module, 'set_cached_reply', lambda key, reply: None)
+    slots = threading.BoundedSemaphore(2)
+    monkeypatch.setattr(app_module, 'assistant_slots', slots)
+    monkeypatch.setattr(stream_slots, 'limit', 2)
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = str(ObjectId())
+    client.db = db
+    client.free_assistant_slots = lambda: slots._value
+    yield client
+    # 名额必须全部归还
+    wait_until(lambda: slots._value == 2)
+    assert stream_slots.in_use == 0
+
+
+def test_json_returns_429_when_executor_is_full(assistant):
+    app_module.assistant_slots.acquire()
+    app_module.assistant_slots.acquire()
+    try:
+        response = assistant.post('/assistant/api', json={'message': '你好'})
+        assert response.status_code == 429
+        assert stream_slots.in_use == 0
+    finally:
+        app_module.assistant_slots.release()
+        app_module.assistant_slots.release()
+
+
+def test_json_hands_off_to_a_job_after_the_wait(assistant, monkeypatch):
+    release = threading.Event()
+
+    def slow_reply(user_id, message):
+        release.wait(5)
+        return '回复'
+
+    monkeypatch.setattr(app_module, 'generate_assistant_reply', slow_reply)
+    monkeypatch.setattr(app_module, 'ASSISTANT_SYNC_WAIT_SECONDS', 0.05)
+
+    response = assistant.post('/assistant/api', json={'message': '你好'})
+    assert response.status_code == 202
+    job_id = ObjectId(response.get_json()['job_id'])
+    assert stream_slots.in_use == 0
+    assert assistant.db.assistant_jobs.documents[job_id]['status'] == 'running'
+
+    release.set()
+    wait_until(lambda: assistant.db.assistant_jobs.documents[job_id]['status'] == 'done')
+    assert assistant.get(f'/assistant/api/jobs/{job_id}').get_json() == {'status': 'done', 'reply': '回复'}
+
+
+def test_json_queues_a_job_when_no_stream_slot_is_free(assistant, monkeypatch):
+    monkeypatch.setattr(app_module, 'generate_assistant_reply', lambda user_id, message: '回复')
+    monkeypatch.setattr(stream_slots, 'limit', 0)
+
+    response = assistant.post('/assistant/api', json={'message': '你好'})
+    assert response.status_code == 202
+    job_id = ObjectId(response.get_json()['job_id'])
+    wait_until(lambda: assistant.db.assistant_jobs.documents[job_id]['status'] == 'done')
+
+
+def test_stream_returns_503_without_a_slot(assistant, monkeypatch):
+    monkeypatch.setattr(stream_slots, 'limit', 0)
+
+    response = assistant.post('/assistant/api/stream', json={'message': '你好'})
+    assert response.status_code == 503
+    assert assistant.free_assistant_slots() == 2
+
+
+def test_stream_releases_slots_when_the_response_closes(assistant, monkeypatch):
+    monkeypatch.setattr(app_module.qwen_client, 'stream_chat', lambda messages: iter(['你', '好']))
+
+    response = assistant.post('/assistant/api/stream', json={'message': '你好'}, buffered=False)
+    assert response.status_code == 200
+    assert stream_slots.in_use == 1
+    body = response.get_data(as_text=True)
+    response.close()
+    assert 'event: done' in body
+    assert stream_slots.in_use == 0
+
+
+def test_stream_releases_slots_when_the_client_disconnects_early(assistant, monkeypatch):
+    started = threading.Event()
+
+    def endless(messages):
+        started.set()
+        while True:
+            time.sleep(0.01)
+            yield '字'
+
+    monkeypatch.setattr(app_module.qwen_client, 'stream_chat', endless)
+
+    response = assistant.post('/assistant/api/stream', json={'message': '你好'}, buffered=False)
+    started.wait(5)
+    response.close()
+    assert stream_slots.in_use == 0
@@ -0,0 +1,31 @@
+"""AI 回复缓存的问题归一化：只合并不改变语义的写法差异，不同的问题不能共用缓存键。"""
+import pytest
+
+from app import assistant_cache_key, normalize_prompt
+
+
+@pytest.mark.parametrize('first, second', [
+    ('血糖>7怎么办', '血糖<7怎么办'),
+    ('1+1等于几', '1-1等于几'),
+    ('血压 140/90 高吗', '血压 14090 高吗'),
+    ('药量减半=0.5片吗', '药量减半05片吗'),
+    ('降到50%可以吗', '降到50可以吗'),
+])
+def test_different_questions_do_not_collide(first, second):
+    assert normalize_prompt(first) != normalize_prompt(second)
+    assert assistant_cache_key(first, 'model') != assistant_cache_key(second, 'model')
+
+
+@pytest.mark.parametrize('first, second', [
+    ('高血压吃什么？', '高血压吃什么'),
+    ('高血压 吃什么!', '高血压吃什么'),
+    ('ＡＢＣ是什么。', 'abc是什么'),
+    ('What  is   BMI?', 'what is bmi'),
+])
+def test_equivalent_questions_share_a_key(first, second):
+    assert normalize_prompt(first) == normalize_prompt(second)
+
+
+def test_spaces_next_to_non_cjk_letters_are_kept():
+    assert normalize_prompt('café au lait') == 'café au lait'
+    assert normalize_prompt('吃 aspirin 可以吗') == '吃 aspirin 可以吗'
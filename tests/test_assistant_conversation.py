@@ -0,0 +1,110 @@
+"""AI 助手多轮对话：上下文预算和并发写入。
+
+用只支持本模块所需运算符的桩集合代替 mongo.db。
+"""
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+import app as app_module
+from app import (ASSISTANT_CONTEXT_TOKENS, build_assistant_messages, estimate_tokens, load_conversation, mongo,
+                 record_conversation_turn)
+
+
+def prompt_tokens(messages):
+    return sum(estimate_tokens(message['content']) for message in messages[1:])
+
+
+def test_long_summary_is_truncated_to_fit_the_question():
+    question = '我最近血压有点高，该注意什么？'
+    conversation = {'summary': '血' * (ASSISTANT_CONTEXT_TOKENS * 2),
+                    'turns': [{'role': 'user', 'content': '你好'}, {'role': 'assistant', 'content': '你好！'}]}
+
+    messages = build_assistant_messages(conversation, question)
+
+    assert messages[-1] == {'role': 'user', 'content': question}
+    assert all(message['content'] != '你好' for message in messages)
+    summary_prefix = len('之前对话的摘要：')
+    assert prompt_tokens(messages) - summary_prefix <= ASSISTANT_CONTEXT_TOKENS
+
+
+def test_question_longer_than_budget_leaves_no_history():
+    question = '问' * (ASSISTANT_CONTEXT_TOKENS + 10)
+    conversation = {'summary': '摘要', 'turns': [{'role': 'user', 'content': '你好'}]}
+
+    messages = build_assistant_messages(conversation, question)
+
+    assert [message['role'] for message in messages] == ['system', 'user']
+
+
+class StubConversations:
+    """单个会话文档；find_one_and_update 的 upsert 在插入前让出一次，模拟两个请求同时插入"""
+
+    def __init__(self, document=None):
+        self.document = document
+        self.racing_insert = None
+
+    def find_one(self, query):
+        return dict(self.document) if self.document else None
+
+    def update_one(self, query, update):
+        document = self.document
+        if document is None or not document.get('updated_at', datetime.min) < query['updated_at']['$lt']:
+            return SimpleNamespace(matched_count=0)
+        document.update(update['$set'])
+        return SimpleNamespace(matched_count=1)
+
+    def find_one_and_update(self, query, update, upsert=False, return_document=None):
+        if self.document is None:
+            if not upsert:
+                return None
+            if self.racing_insert:
+                # 另一个请求抢先插入了同一个 _id
+                racing_insert, self.racing_insert = self.racing_insert, None
+                racing_insert()
+                raise DuplicateKeyError('E11000 duplicate key error')
+            self.document = {'_id': query['_id'], 'turns': []}
+            self.document.update(update['$setOnInsert'])
+        self.document['turns'].extend(update['$push']['turns']['$each'])
+        self.document.update(update['$set'])
+        return self.document
+
+
+@pytest.fixture
+def conversations(monkeypatch):
+    stub = StubConversations()
+    monkeypatch.setattr(mongo, 'db', SimpleNamespace(assistant_conversations=stub))
+    monkeypatch.setattr(app_module, 'submit_assistant_call', lambda *args: None)
+    return stub
+
+
+def contents(stub):
+    return [turn['content'] for turn in stub.document['turns']]
+
+
+def test_concurrent_first_questions_keep_both_turns(conversations):
+    user_id = ObjectId()
+    first, second = load_conversation(user_id), load_conversation(user_id)
+    conversations.racing_insert = lambda: record_conversation_turn(first, '问一', '答一')
+
+    record_conversation_turn(second, '问二', '答二')
+
+    assert contents(conversations) == ['问一', '答一', '问二', '答二']
+    assert conversations.document['summary'] is None
+
+
+def test_idle_conversation_is_reset_once(conversations):
+    user_id = ObjectId()
+    conversations.document = {'_id': user_id, 'summary': '旧摘要', 'turns': [{'role': 'user', 'content': '旧问题'}],
+                              'updated_at': datetime.utcnow() - timedelta(days=1)}
+    first, second = load_conversation(user_id), load_conversation(user_id)
+    assert first['is_new'] and second['is_new']
+
+    record_conversation_turn(first, '问一', '答一')
+    record_conversation_turn(second, '问二', '答二')
+
+    assert contents(conversations) == ['问一', '答一', '问二', '答二']
+    assert conversations.document['summary'] is None
@@ -0,0 +1,76 @@
+"""跨 worker 事件流：tail 游标重建后，其他进程在同一秒内插入、_id 更小的消息不能丢失。
+
+用按插入顺序返回文档的桩 capped 集合代替 MongoDB，每次 find 返回的游标读完即失效，模拟游标重建。
+"""
+import time
+
+from bson import ObjectId
+
+from app import CappedCollectionBrokerBackend
+
+
+def object_id(timestamp, process_bytes, counter):
+    """构造指定时间戳、进程随机字节和计数器的 ObjectId，模拟不同 gunicorn worker 生成的 _id"""
+    return ObjectId(timestamp.to_bytes(4, 'big') + process_bytes + counter.to_bytes(3, 'big'))
+
+
+def matches(document, query):
+    for field, condition in query.items():
+        for op, operand in condition.items():
+            if op == '$gte' and not document[field] >= operand:
+                return False
+    return True
+
+
+class StubCursor:
+    def __init__(self, documents):
+        self.documents = documents
+        self.alive = True
+
+    def max_await_time_ms(self, ms):
+        return self
+
+    def __iter__(self):
+        documents, self.documents = self.documents, []
+        self.alive = False
+        return iter(documents)
+
+
+class StubCappedCollection:
+    def __init__(self):
+        self.documents = []
+
+    def insert(self, doc_id, channel, event):
+        self.documents.append({'_id': doc_id, 'channel': channel, 'message': {'event': event, 'data': {}}})
+
+    def find(self, query, projection=None, cursor_type=None):
+        return StubCursor([doc for doc in self.documents if matches(doc, query)])
+
+
+class RecordingBroker:
+    def __init__(self):
+        self.messages = []
+
+    def dispatch(self, channel, message):
+        self.messages.append((channel, message['event']))
+
+
+def test_rebuilt_cursor_delivers_lower_id_inserted_later():
+    now = int(time.time())
+    worker_a, worker_b = b'\xff' * 5, b'\x00' * 5
+    collection = StubCappedCollection()
+    broker = RecordingBroker()
+    backend = CappedCollectionBrokerBackend(broker, 'event_stream')
+
+    collection.insert(object_id(now - 5, worker_a, 1), 'elder-1', 'before-subscribe')
+    backend._tail_once(collection)
+    assert broker.messages == []
+
+    # worker A 先插入；同一秒内 worker B 生成的 _id 更小，但在游标重建之后才插入
+    collection.insert(object_id(now, worker_a, 2), 'elder-1', 'from-a')
+    backend._tail_once(collection)
+    collection.insert(object_id(now, worker_b, 1), 'assistant-cache', 'from-b')
+    backend._tail_once(collection)
+    backend._tail_once(collection)
+
+    assert broker.messages == [('elder-1', 'from-a'), ('assistant-cache', 'from-b')]
@@ -0,0 +1,89 @@
+"""view_event 的查询次数回归测试：参与者再多，也只查询一次 events 和一次 users。
+
+用记录调用的桩集合代替 mongo.db，不需要运行中的 MongoDB。
+"""
+from datetime import datetime
+
+import pytest
+from bson import ObjectId
+
+from app import app, create_app, mongo
+
+
+class RecordingCollection:
+    def __init__(self, name, documents, commands):
+        self.name = name
+        self.documents = documents
+        self.commands = commands
+
+    def _matches(self, document, query):
+        for field, condition in query.items():
+            if isinstance(condition, dict) and '$in' in condition:
+                if document.get(field) not in condition['$in']:
+                    return False
+            elif document.get(field) != condition:
+                return False
+        return True
+
+    def find(self, query=None, projection=None):
+        self.commands.append((self.name, 'find'))
+        return [doc for doc in self.documents if self._matches(doc, query or {})]
+
+    def find_one(self, query=None, projection=None):
+        self.commands.append((self.name, 'find_one'))
+        return next((doc for doc in self.documents if self._matches(doc, query or {})), None)
+
+
+class RecordingDatabase:
+    def __init__(self, collections):
+        self.commands = []
+        self.collections = {name: RecordingCollection(name, docs, self.commands)
+                             for name, docs in collections.items()}
+
+    def __getattr__(self, name):
+        return self.collections.setdefault(name, RecordingCollection(name, [], self.commands))
+
+    __getitem__ = __getattr__
+
+
+def build_database(participant_count):
+    now = datetime(2025, 1, 1, 9, 0)
+    users = [{'_id': ObjectId(), 'name': f'参与者{i}', 'email': f'user{i}@example.com'}
+             for i in range(participant_count)]
+    event = {
+        '_id': ObjectId(),
+        'title': '晨练',
+        'description': '公园太极',
+        'datetime': now,
+        'location': '公园',
+        'max_participants': 100,
+        'participants': [user['_id'] for user in users],
+        'participant_join_times': {str(user['_id']): now for user in users},
+        'created_by': users[0]['_id'],
+        'created_at': now,
+    }
+    return RecordingDatabase({'events': [event], 'users': users}), event, users
+
+
+@pytest.fixture
+def client():
+    create_app({'MONGO_URI': 'mongodb://localhost:27017/test', 'SECRET_KEY': 'test', 'TESTING': True})
+    return app.test_client()
+
+
+def view_event_commands(client, monkeypatch, participant_count):
+    db, event, users = build_database(participant_count)
+    monkeypatch.setattr(mongo, 'db', db)
+    with client.session_transaction() as sess:
+        sess['user_id'] = str(users[0]['_id'])
+    response = client.get(f"/event/{event['_id']}")
+    assert response.status_code == 200
+    assert users[-1]['name'] in response.get_data(as_text=True)
+    return db.commands
+
+
+def test_view_event_query_count_does_not_grow_with_participants(client, monkeypatch):
+    one = view_event_commands(client, monkeypatch, 1)
+    fifty = view_event_commands(client, monkeypatch, 50)
+    assert one == [('events', 'find_one'), ('users', 'find')]
+    assert fifty == one